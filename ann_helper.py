@@ -0,0 +1,223 @@
+import os
+import time
+import numpy as np
+
+import library_helper
+import lookup_helper
+import index_helper
+
+# Approximate nearest-neighbour index over the spectrum library: the spectra are projected onto a few principal
+# components, clustered into coarse cells by k-means in that basis, and stored as one inverted list of row ids per
+# cell. A query only reads the rows of the cells whose centroid is closest to the target and scores them exactly.
+# Centroids are compared with the target at its keypoints only (each centroid is mapped back to a spectrum through
+# the basis, then masked), so sparse keypoint targets work the same way as full spectra.
+
+ANN_INDEX_DIR = 'ann_index'
+ANN_INDEX_NAME = 'index.npz'
+ANN_IDS_NAME = 'ids.npy'
+
+
+# index of the closest centroid of every point, in chunks to bound the size of the distance matrix
+def assign_cells(points, centroids, chunk_size=2**15):
+    cells = np.empty(len(points), dtype=np.int32)
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 does not change the argmin
+        cells[start:start + chunk_size] = np.argmin(centroid_norms - 2 * np.matmul(chunk, centroids.T), axis=1)
+    return cells
+
+
+def kmeans(points, n_cells, n_iter=20, seed=0):
+    """
+    Lloyd's k-means, initialised with randomly chosen points
+    :param points: array of shape (n, d)
+    :param n_cells: number of clusters
+    :param n_iter: number of iterations
+    :param seed: seed of the initialisation
+    :return: centroids of shape (n_cells, d)
+    """
+    rng = np.random.RandomState(seed)
+    centroids = points[rng.choice(len(points), n_cells, replace=False)].copy()
+    for cnt in range(n_iter):
+        cells = assign_cells(points, centroids)
+        counts = np.bincount(cells, minlength=n_cells)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, cells, points)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        # restart empty cells on random points, so that every cell ends up being used
+        n_empty = int(np.sum(~filled))
+        if n_empty:
+            centroids[~filled] = points[rng.choice(len(points), n_empty, replace=False)]
+    return centroids
+
+
+def build_ann_index(lib_dir, n_components=16, n_cells=4096, sample_size=2**18, n_iter=20, seed=0):
+    """
+    Build the ANN index of a library, the basis and the cells are fitted on a random sample of the spectra, then
+    every spectrum of the library is assigned to its cell
+    :param lib_dir: library directory, in any format library_helper.open_library() can read
+    :param n_components: number of principal components of the basis
+    :param n_cells: number of cells, around sqrt(n_rows) balances the cost of ranking the cells and reading them
+    :param sample_size: number of spectra used to fit the basis and the cells
+    :param n_iter: k-means iterations
+    :param seed: random seed
+    :return: the AnnIndex
+    """
+    library = library_helper.open_library(lib_dir)
+    index_dir = os.path.join(lib_dir, ANN_INDEX_DIR)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    start = time.time()
+
+    # principal components of a sample of the library
+    rng = np.random.RandomState(seed)
+    sample_ids = np.sort(rng.choice(library.n_rows, min(sample_size, library.n_rows), replace=False))
+    sample = library.take(sample_ids).astype(np.float32)
+    mean = sample.mean(axis=0)
+    _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    components = vt[:n_components].astype(np.float32)
+    centroids = kmeans(np.matmul(sample - mean, components.T), n_cells, n_iter=n_iter, seed=seed)
+    print('fitted {} components and {} cells, time taken is {}'.format(n_components, n_cells,
+                                                                       np.round(time.time() - start)))
+
+    # assign every spectrum of the library to its cell, the cells are kept in a temporary file rather than in memory
+    shards = sorted(tuple(shard) for shard in library.shards)
+    cells_path = os.path.join(index_dir, 'cells.npy.tmp')
+    cells = np.lib.format.open_memmap(cells_path, mode='w+', dtype=np.int32, shape=(library.n_rows,))
+    counts = np.zeros(n_cells, dtype=np.int64)
+    for cnt, (shard_start, shard_stop) in enumerate(shards):
+        projected = np.matmul(library.rows(shard_start, shard_stop).astype(np.float32) - mean, components.T)
+        shard_cells = assign_cells(projected, centroids)
+        cells[shard_start:shard_stop] = shard_cells
+        counts += np.bincount(shard_cells, minlength=n_cells)
+        if cnt % 1000 == 0:
+            print('assigned shard {} of {}'.format(cnt, len(shards)))
+
+    # inverted lists: row ids grouped by cell, ascending within each cell, placed shard by shard by a counting sort
+    id_dtype = np.uint32 if library.n_rows < 2**32 else np.int64
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    ids_path = os.path.join(index_dir, ANN_IDS_NAME + '.tmp')
+    ids = np.lib.format.open_memmap(ids_path, mode='w+', dtype=id_dtype, shape=(library.n_rows,))
+    cursors = offsets[:-1].copy()
+    for shard_start, shard_stop in shards:
+        index_helper.place_ids(ids, cursors, np.asarray(cells[shard_start:shard_stop]), shard_start)
+    ids.flush()
+    del ids, cells
+    os.replace(ids_path, os.path.join(index_dir, ANN_IDS_NAME))
+    os.remove(cells_path)
+    np.savez(os.path.join(index_dir, ANN_INDEX_NAME), n_rows=library.n_rows, mean=mean, components=components,
+             centroids=centroids, offsets=offsets)
+    print('built the ann index, time taken is {}'.format(np.round(time.time() - start)))
+    return AnnIndex(lib_dir)
+
+
+class AnnIndex(object):
+    """
+    Reads the index written by build_ann_index() and answers queries against it
+    """
+    def __init__(self, lib_dir):
+        """
+        :param lib_dir: library directory
+        """
+        self.lib_dir = lib_dir
+        index_dir = os.path.join(lib_dir, ANN_INDEX_DIR)
+        with np.load(os.path.join(index_dir, ANN_INDEX_NAME)) as index:
+            self.n_rows = int(index['n_rows'])
+            self.mean = index['mean']
+            self.components = index['components']
+            self.centroids = index['centroids']
+            self.offsets = index['offsets']
+        self.ids = np.load(os.path.join(index_dir, ANN_IDS_NAME), mmap_mode='r')
+        # centroids mapped back to spectra, so they can be compared with the target at its keypoints only
+        self.cell_spectra = self.mean + np.matmul(self.centroids, self.components)
+
+    def rank_cells(self, key_idx, key_val):
+        """
+        :return: cells sorted from the closest to the farthest from the keypoints
+        """
+        diff = self.cell_spectra[:, key_idx] - key_val
+        return np.argsort(np.einsum('ij,ij->i', diff, diff), kind='stable')
+
+    def search(self, key_idx, key_val, k, n_probe=8, chunk_size=2**16):
+        """
+        Score the spectra of the n_probe cells closest to the keypoints
+        :param key_idx: wavelength indices of the keypoints
+        :param key_val: values of the keypoints, as returned by lookup_helper.get_keypoints()
+        :param k: number of candidates
+        :param n_probe: number of cells read
+        :param chunk_size: number of rows read from the library at a time
+        :return: mses and library rows of the candidates, sorted from best to worst, and the number of rows scored
+        """
+        library = library_helper.open_library(self.lib_dir)
+        assert library.n_rows == self.n_rows, "the ann index is out of date, rebuild it"
+        cells = np.sort(self.rank_cells(key_idx, key_val)[:n_probe])
+        ids = np.concatenate([self.ids[self.offsets[cell]:self.offsets[cell + 1]] for cell in cells])
+        ids = np.sort(ids.astype(np.int64))
+        top = lookup_helper.TopK(k)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            top.push(lookup_helper.mse_batch(library.take(chunk), key_idx, key_val), indices=chunk)
+        mses, indices = top.results()
+        return mses, indices, len(ids)
+
+
+# exact top k of the whole library, the reference the ann search is measured against
+def exact_search(lib_dir, key_idx, key_val, k, n_workers=1):
+    library = library_helper.open_library(lib_dir)
+    top = lookup_helper.TopK(k)
+    for _, shard_top, _, _ in lookup_helper.scan_shards(lib_dir, library.shards, key_idx, key_val, k,
+                                                        n_workers=n_workers):
+        top.merge(shard_top)
+    return top.results()
+
+
+def benchmark_queries(lib_dir, n_queries=50, n_keypoints=(5, 10, 20, 300), seed=0):
+    """
+    Make a benchmark query set from spectra of the library itself, keeping only a few random keypoints of each
+    :param lib_dir: library directory
+    :param n_queries: number of queries
+    :param n_keypoints: number of keypoints of the queries, cycled through (300 is a full spectrum)
+    :param seed: random seed
+    :return: list of sstar targets, lists of 300 values with None at every undefined wavelength
+    """
+    library = library_helper.open_library(lib_dir)
+    rng = np.random.RandomState(seed)
+    spectra = library.take(np.sort(rng.choice(library.n_rows, n_queries, replace=False)))
+    queries = []
+    for cnt, spectrum in enumerate(spectra):
+        n_keys = min(n_keypoints[cnt % len(n_keypoints)], library.spec_len)
+        keys = set(rng.choice(library.spec_len, n_keys, replace=False).tolist())
+        queries.append([int(value) if pos in keys else None for pos, value in enumerate(spectrum)])
+    return queries
+
+
+def recall_report(lib_dir, queries, k=10, n_probes=(1, 2, 4, 8, 16, 32), n_workers=1):
+    """
+    Measure the recall of the ann search against the exact search, for several numbers of probed cells
+    :param lib_dir: library directory with an ann index
+    :param queries: list of sstar targets, e.g. from benchmark_queries()
+    :param k: number of candidates
+    :param n_probes: numbers of probed cells to compare
+    :param n_workers: number of worker processes of the exact search
+    :return: list with one dict per n_probe: mean recall@k, mean fraction of the library scored and mean query time
+    """
+    index = AnnIndex(lib_dir)
+    keypoints = [lookup_helper.get_keypoints(sstar) for sstar in queries]
+    exact = [exact_search(lib_dir, key_idx, key_val, k, n_workers=n_workers)[1] for key_idx, key_val in keypoints]
+    report = []
+    for n_probe in n_probes:
+        recalls, scanned, times = [], [], []
+        for (key_idx, key_val), exact_indices in zip(keypoints, exact):
+            start = time.time()
+            _, indices, n_scored = index.search(key_idx, key_val, k, n_probe=n_probe)
+            times.append(time.time() - start)
+            recalls.append(len(np.intersect1d(indices, exact_indices)) / len(exact_indices))
+            scanned.append(n_scored / index.n_rows)
+        report.append({'n_probe': n_probe, 'recall': float(np.mean(recalls)), 'scanned': float(np.mean(scanned)),
+                       'time': float(np.mean(times))})
+    print('{:>8} {:>10} {:>10} {:>10}'.format('n_probe', 'recall@{}'.format(k), 'scanned', 'time (s)'))
+    for row in report:
+        print('{n_probe:>8} {recall:>10.3f} {scanned:>10.3%} {time:>10.4f}'.format(**row))
+    return report
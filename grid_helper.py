@@ -0,0 +1,255 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+
+# The geometry grid written by lookup.gen_data() is a regular 8-D lattice, h1 outermost and r4 innermost, so the
+# geometry of any library row follows from its index by mixed-radix decoding. GridDescriptor does this conversion
+# (and the reverse) vectorized, which avoids scanning grid.csv to find the geometries of the candidates.
+
+GRID_NAME = 'grid.json'
+PARAM_NAMES = ('h1', 'h2', 'h3', 'h4', 'r1', 'r2', 'r3', 'r4')
+
+
+class GridDescriptor(object):
+    """
+    Describes the lattice of geometries generated from param_bounds and spacings
+    """
+    def __init__(self, param_bounds, spacings):
+        """
+        Initialize the descriptor, the values of each parameter are np.arange(low, high, spacing) as in gen_data()
+        :param param_bounds: array of shape (8, 2) with the [low, high) bounds of h1..h4, r1..r4
+        :param spacings: spacing of each parameter
+        """
+        self.param_bounds = np.asarray(param_bounds, dtype=np.float64)
+        self.spacings = np.asarray(spacings, dtype=np.float64)
+        assert self.param_bounds.shape == (len(PARAM_NAMES), 2) and len(self.spacings) == len(PARAM_NAMES)
+        self.values = [np.arange(low, high, spacing) for (low, high), spacing in zip(self.param_bounds,
+                                                                                    self.spacings)]
+        self.shape = tuple(len(values) for values in self.values)
+        self.n_rows = int(np.prod(self.shape, dtype=np.int64))
+
+    def digits(self, indices):
+        """
+        :param indices: grid row indices (0-based)
+        :return: int64 array of shape (n, 8) with the position of each parameter along its axis
+        """
+        return np.stack(np.unravel_index(np.asarray(indices, dtype=np.int64), self.shape), axis=1)
+
+    def params(self, indices):
+        """
+        :param indices: grid row indices (0-based)
+        :return: array of shape (n, 8) with h1..h4, r1..r4 of each row
+        """
+        digits = self.digits(indices)
+        return np.stack([values[digits[:, cnt]] for cnt, values in enumerate(self.values)], axis=1)
+
+    def geometry(self, indices):
+        """
+        :param indices: grid row indices (0-based)
+        :return: array of shape (n, 24), the rows of grid.csv, i.e. h1..h4, r1..r4 and the 16 ratios r/h
+        """
+        return np.round(add_ratios(self.params(indices)), 1)
+
+    def index(self, params):
+        """
+        :param params: array of shape (n, 8) with h1..h4, r1..r4, snapped to the nearest lattice point
+        :return: grid row indices (0-based)
+        """
+        params = np.atleast_2d(params)
+        digits = np.rint((params[:, :len(PARAM_NAMES)] - self.param_bounds[:, 0]) / self.spacings).astype(np.int64)
+        digits = np.clip(digits, 0, np.array(self.shape) - 1)
+        return np.ravel_multi_index(tuple(digits.T), self.shape)
+
+    def digit_bounds(self, constraints):
+        """
+        :param constraints: dict of parameter name (one of PARAM_NAMES, or 'h' / 'r' for all four heights / radii)
+        -> (low, high) inclusive bounds in the units of the grid, e.g. {'r': (42, 48.6), 'h1': (40, 40)}
+        :return: int64 arrays lo and hi of shape (8,), the rows within the constraints are those whose digits
+        satisfy lo <= digit < hi on every axis. Raises ValueError for an unknown parameter name
+        """
+        lo = np.zeros(len(PARAM_NAMES), dtype=np.int64)
+        hi = np.array(self.shape, dtype=np.int64)
+        for name, (low, high) in constraints.items():
+            axes = [cnt for cnt, param in enumerate(PARAM_NAMES) if param == name or param[0] == name]
+            if len(axes) == 0:
+                raise ValueError("unknown parameter {}, expected one of {} or h, r".format(name, PARAM_NAMES))
+            for axis in axes:
+                # the lattice values are float aranges, so compare with a tolerance well below the spacing
+                eps = 1e-6 * self.spacings[axis]
+                inside = np.flatnonzero((self.values[axis] >= low - eps) & (self.values[axis] <= high + eps))
+                if len(inside) == 0:
+                    lo[axis], hi[axis] = 0, 0
+                else:
+                    lo[axis], hi[axis] = max(lo[axis], inside[0]), min(hi[axis], inside[-1] + 1)
+        return lo, np.maximum(hi, lo)
+
+    def count_below(self, rows, lo, hi):
+        """
+        :param rows: grid row indices, may be n_rows
+        :param lo: lower digit bounds, see digit_bounds()
+        :param hi: upper digit bounds (exclusive)
+        :return: number of grid rows within the bounds that lie below each of rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = np.zeros(rows.shape, dtype=np.int64)
+        # mixed radix counting, outer axis first: rows sharing the digits of x so far and a smaller digit on the
+        # current axis are all below x, as long as the shared digits are within the bounds
+        digits = np.stack(np.unravel_index(np.minimum(rows, self.n_rows - 1), self.shape), axis=-1)
+        inner = np.concatenate([np.cumprod((hi - lo)[::-1])[::-1][1:], [1]])
+        valid = np.ones(rows.shape, dtype=bool)
+        for axis in range(len(self.shape)):
+            digit = digits[..., axis]
+            counts += valid * np.clip(np.minimum(digit, hi[axis]) - lo[axis], 0, None) * inner[axis]
+            valid &= (digit >= lo[axis]) & (digit < hi[axis])
+        # row n_rows is past the last row, everything within the bounds lies below it
+        return np.where(rows >= self.n_rows, int(np.prod(hi - lo)), counts)
+
+    def row_ranges(self, lo, hi, start=0, stop=None):
+        """
+        The grid is lexicographic, so the rows within box bounds form runs of consecutive rows: one run per
+        combination of the digits of the axes before the innermost bounded axis
+        :param lo: lower digit bounds, see digit_bounds()
+        :param hi: upper digit bounds (exclusive)
+        :param start: first row of interest
+        :param stop: last row of interest (exclusive), defaults to n_rows
+        :return: int64 array of shape (n, 2) with the [start, stop) rows of each run within [start, stop), ascending
+        """
+        stop = self.n_rows if stop is None else stop
+        if np.any(hi <= lo) or stop <= start:
+            return np.empty((0, 2), dtype=np.int64)
+        bounded = np.flatnonzero((lo > 0) | (hi < np.array(self.shape)))
+        if len(bounded) == 0:
+            return np.array([[start, stop]], dtype=np.int64)
+        axis = bounded[-1]
+        strides = np.concatenate([np.cumprod(self.shape[::-1])[::-1][1:], [1]]).astype(np.int64)
+        # runs start at the blocks of rows sharing the digits of the axes before axis
+        block = strides[axis] * self.shape[axis]
+        blocks = np.arange(start // block, (stop - 1) // block + 1, dtype=np.int64)
+        if axis > 0:
+            prefix = np.stack(np.unravel_index(blocks, self.shape[:axis]), axis=1)
+            blocks = blocks[np.all((prefix >= lo[:axis]) & (prefix < hi[:axis]), axis=1)]
+        run_start = blocks * block + lo[axis] * strides[axis]
+        run_stop = blocks * block + hi[axis] * strides[axis]
+        ranges = np.stack([np.maximum(run_start, start), np.minimum(run_stop, stop)], axis=1)
+        return ranges[ranges[:, 0] < ranges[:, 1]]
+
+    def save(self, out_dir):
+        with open(os.path.join(out_dir, GRID_NAME), 'w') as f:
+            json.dump({'param_bounds': self.param_bounds.tolist(), 'spacings': self.spacings.tolist()}, f, indent=1)
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: grid.json or the directory holding it
+        :return: GridDescriptor
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, GRID_NAME)
+        with open(path, 'r') as f:
+            grid = json.load(f)
+        return GridDescriptor(grid['param_bounds'], grid['spacings'])
+
+
+# append the 16 derived r/h ratio columns, in the order gen_data() writes them
+def add_ratios(params):
+    heights = params[:, 0:4]
+    radii = params[:, 4:8]
+    ratios = radii[:, np.newaxis, :] / heights[:, :, np.newaxis]  # ratios[:, i, j] = r_j / h_i
+    return np.concatenate([params, ratios.reshape(len(params), 16)], axis=1)
+
+
+def find_grid(*paths):
+    """
+    Look for a saved grid descriptor
+    :param paths: grid.json files, directories that may hold one (e.g. the library directory) or files that may
+    have one next to them (e.g. grid.csv)
+    :return: GridDescriptor of the first one found, None if there is none
+    """
+    for path in paths:
+        if path is None:
+            continue
+        if not os.path.isdir(path) and not path.endswith('.json'):
+            path = os.path.dirname(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, GRID_NAME)
+        if os.path.exists(path):
+            return GridDescriptor.load(path)
+    return None
+
+
+# fall back for grids without a descriptor: scan grid.csv for the requested rows
+def read_grid_rows(geometries_path, indices):
+    """
+    :param geometries_path: path to grid.csv
+    :param indices: grid row indices (0-based)
+    :return: array of shape (n, 24) with the requested rows, in the order of indices
+    """
+    wanted = {}
+    for pos, index in enumerate(indices):
+        wanted.setdefault(int(index), []).append(pos)
+    geoms = [None] * len(indices)
+    found = 0
+    with open(geometries_path, 'r') as geom_file:
+        for line_cnt, line in enumerate(geom_file):
+            if line_cnt in wanted:
+                for pos in wanted[line_cnt]:
+                    geoms[pos] = [float(string) for string in line.split(',')]
+                found += 1
+                if found == len(wanted):
+                    break
+    return np.array(geoms)
+
+
+# block files written by write_grid(), named so that sorting them gives the grid order
+def block_name(block_id):
+    return 'grid_{}.npy'.format(str(block_id).zfill(5))
+
+
+# compute one block of grid rows and save it, run inside the worker processes of write_grid()
+def write_grid_block(task):
+    """
+    :param task: tuple of (output directory, param_bounds, spacings, block id, rows per block)
+    :return: block id and the number of rows written
+    """
+    out_dir, param_bounds, spacings, block_id, block_rows = task
+    grid = GridDescriptor(param_bounds, spacings)
+    indices = np.arange(block_id * block_rows, min((block_id + 1) * block_rows, grid.n_rows), dtype=np.int64)
+    geoms = grid.geometry(indices).astype(np.float32)
+    # write to a temporary file first, so a block file that exists is always complete
+    tmp_path = os.path.join(out_dir, block_name(block_id) + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, geoms, allow_pickle=False)
+    os.replace(tmp_path, os.path.join(out_dir, block_name(block_id)))
+    return block_id, len(indices)
+
+
+def write_grid(out_dir, param_bounds, spacings, block_rows=2**22, n_workers=1):
+    """
+    Write the whole grid as float32 .npy blocks of shape (block_rows, 24), plus its grid.json descriptor.
+    Blocks that already exist are skipped, so an interrupted run resumes where it stopped (rerun it with the same
+    block_rows)
+    :param out_dir: output directory
+    :param param_bounds: array of shape (8, 2) with the [low, high) bounds of h1..h4, r1..r4
+    :param spacings: spacing of each parameter
+    :param block_rows: number of grid rows per block
+    :param n_workers: number of worker processes
+    :return: number of blocks written by this call
+    """
+    grid = GridDescriptor(param_bounds, spacings)
+    grid.save(out_dir)
+    n_blocks = (grid.n_rows + block_rows - 1) // block_rows
+    tasks = [(out_dir, grid.param_bounds, grid.spacings, block_id, block_rows) for block_id in range(n_blocks)
+             if not os.path.exists(os.path.join(out_dir, block_name(block_id)))]
+    print('{} of {} grid blocks left to write'.format(len(tasks), n_blocks))
+    if n_workers <= 1:
+        results = map(write_grid_block, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(write_grid_block, tasks)
+    for cnt, (block_id, rows) in enumerate(results, 1):
+        print('wrote block {} ({} rows), {} of {} done'.format(block_id, rows, cnt, len(tasks)))
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+    return len(tasks)
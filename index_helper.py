@@ -0,0 +1,196 @@
+import os
+import json
+import numpy as np
+
+import library_helper
+import lookup_helper
+
+# Secondary index over the spectrum library for banded queries such as "transmission at wavelength 65 within
+# 0.56 +- 0.02 and at wavelength 82 within 0.2 +- 0.02". For each indexed wavelength the library row ids are kept
+# sorted by their uint8 value, with the offset of every value, so the rows inside a band are one contiguous slice of
+# the id array. A query intersects the slices of its most selective bands and only reads and scores the survivors.
+
+SORTED_INDEX_DIR = 'sorted_index'
+SORTED_INDEX_MANIFEST = 'manifest.json'
+
+
+def ids_name(wavelength):
+    return 'ids_{}.npy'.format(str(wavelength).zfill(3))
+
+
+def build_sorted_index(lib_dir, wavelengths, wavelengths_per_pass=8):
+    """
+    Build (or extend) the sorted index of a library for the given wavelengths. The ids are placed by a counting sort
+    in two passes over the library: the first counts the rows of every value, which gives the offsets, the second
+    writes the ids of each shard, in ascending order within each value, straight into memory-mapped id files. Only
+    one shard is held in memory at a time
+    :param lib_dir: library directory, in any format library_helper.open_library() can read
+    :param wavelengths: wavelength indices to index, e.g. the ones design queries usually constrain
+    :param wavelengths_per_pass: number of wavelengths indexed per pair of passes over the library
+    :return: the SortedIndex
+    """
+    library = library_helper.open_library(lib_dir)
+    index_dir = os.path.join(lib_dir, SORTED_INDEX_DIR)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    manifest = read_sorted_index_manifest(index_dir)
+    if manifest is None or manifest['n_rows'] != library.n_rows:
+        manifest = {'n_rows': library.n_rows, 'offsets': {}}
+    # row ids fit in uint32 for any library below 4G rows, which halves the size of the index
+    id_dtype = np.uint32 if library.n_rows < 2**32 else np.int64
+    # the ids of each value must come out ascending, so the shards are placed in row order
+    shards = sorted(tuple(shard) for shard in library.shards)
+
+    wavelengths = sorted(set(int(wavelength) for wavelength in wavelengths))
+    for first in range(0, len(wavelengths), wavelengths_per_pass):
+        group = wavelengths[first:first + wavelengths_per_pass]
+        counts = np.zeros((len(group), 256), dtype=np.int64)
+        for start, stop in shards:
+            columns = library.rows(start, stop)[:, group].T
+            for cnt, column in enumerate(columns):
+                counts[cnt] += np.bincount(column, minlength=256)
+        offsets = np.concatenate([np.zeros((len(group), 1), dtype=np.int64), np.cumsum(counts, axis=1)], axis=1)
+        tmp_paths = [os.path.join(index_dir, ids_name(wavelength) + '.tmp') for wavelength in group]
+        ids = [np.lib.format.open_memmap(tmp_path, mode='w+', dtype=id_dtype, shape=(library.n_rows,))
+               for tmp_path in tmp_paths]
+        # next free position of every value in each id array
+        cursors = offsets[:, :-1].copy()
+        for start, stop in shards:
+            columns = library.rows(start, stop)[:, group].T
+            for cnt, column in enumerate(columns):
+                place_ids(ids[cnt], cursors[cnt], column, start)
+        for wavelength_ids in ids:
+            wavelength_ids.flush()
+        del ids
+        for wavelength, tmp_path, wavelength_offsets in zip(group, tmp_paths, offsets):
+            os.replace(tmp_path, os.path.join(index_dir, ids_name(wavelength)))
+            manifest['offsets'][str(wavelength)] = wavelength_offsets.tolist()
+            print('indexed wavelength {}'.format(wavelength))
+        # record each group as soon as it is done, so an interrupted build keeps the finished wavelengths
+        write_sorted_index_manifest(index_dir, manifest)
+    return SortedIndex(lib_dir)
+
+
+# second pass of a counting sort: write the ids of one shard of rows at the next free positions of their values
+def place_ids(ids, cursors, values, start):
+    """
+    :param ids: id array being filled, e.g. a memory-mapped .npy file
+    :param cursors: next free position of every value in ids, advanced past the rows of the shard
+    :param values: value of every row of the shard
+    :param start: id of the first row of the shard
+    :return:
+    """
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    shard_counts = np.bincount(values, minlength=len(cursors))
+    # position of each sorted row within the run of its value in this shard
+    rank = np.arange(len(order)) - (np.cumsum(shard_counts) - shard_counts)[sorted_values]
+    ids[cursors[sorted_values] + rank] = order + start
+    cursors += shard_counts
+
+
+def read_sorted_index_manifest(index_dir):
+    path = os.path.join(index_dir, SORTED_INDEX_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_sorted_index_manifest(index_dir, manifest):
+    tmp_path = os.path.join(index_dir, SORTED_INDEX_MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(index_dir, SORTED_INDEX_MANIFEST))
+
+
+class SortedIndex(object):
+    """
+    Reads the sorted index written by build_sorted_index(), the id arrays are memory mapped
+    """
+    def __init__(self, lib_dir):
+        """
+        :param lib_dir: library directory
+        """
+        self.index_dir = os.path.join(lib_dir, SORTED_INDEX_DIR)
+        manifest = read_sorted_index_manifest(self.index_dir)
+        assert manifest is not None, "{} has no sorted index, see build_sorted_index()".format(lib_dir)
+        self.n_rows = manifest['n_rows']
+        self.offsets = {int(wavelength): np.array(offsets, dtype=np.int64)
+                        for wavelength, offsets in manifest['offsets'].items()}
+        self.wavelengths = sorted(self.offsets)
+        self.ids = {}
+
+    def band_count(self, wavelength, low, high):
+        """
+        :return: number of library rows whose value at wavelength lies in [low, high]
+        """
+        offsets = self.offsets[wavelength]
+        return int(offsets[high + 1] - offsets[low])
+
+    def band_ids(self, wavelength, low, high):
+        """
+        :return: ids of the library rows whose value at wavelength lies in [low, high], ascending within each value
+        """
+        if wavelength not in self.ids:
+            self.ids[wavelength] = np.load(os.path.join(self.index_dir, ids_name(wavelength)), mmap_mode='r')
+        offsets = self.offsets[wavelength]
+        return self.ids[wavelength][offsets[low]:offsets[high + 1]]
+
+
+# turn targets in transmission units into bands of library values
+def transmission_bands(targets, scale=255):
+    """
+    :param targets: dict of wavelength index -> (transmission, tolerance), e.g. {65: (0.56, 0.02)}
+    :param scale: quantisation scale of the library
+    :return: dict of wavelength index -> (low, high) library values, inclusive: the values whose rounding interval
+    [v - 0.5, v + 0.5] / scale overlaps the tolerance, i.e. every row whose transmission may lie within it and none
+    that cannot
+    """
+    bands = {}
+    for wavelength, (centre, tolerance) in targets.items():
+        low = int(np.clip(np.ceil((centre - tolerance) * scale - 0.5), 0, scale))
+        high = int(np.clip(np.floor((centre + tolerance) * scale + 0.5), 0, scale))
+        bands[int(wavelength)] = (low, high)
+    return bands
+
+
+def band_search(lib_dir, bands, candidate_num, n_intersect=2, chunk_size=2**16):
+    """
+    Find the library rows that lie within every band, ranked by their mse to the centres of the bands
+    :param lib_dir: library directory with a sorted index
+    :param bands: dict of wavelength index -> (low, high) library values, inclusive, see transmission_bands()
+    :param candidate_num: number of candidates to return
+    :param n_intersect: number of indexed bands whose id sets are intersected, the most selective first. The other
+    bands are checked on the spectra of the survivors
+    :param chunk_size: number of survivors read from the library at a time
+    :return: mses and library rows of the best candidates, sorted from best to worst, and the number of survivors
+    """
+    library = library_helper.open_library(lib_dir)
+    index = SortedIndex(lib_dir)
+    assert index.n_rows == library.n_rows, "the sorted index is out of date, rebuild it"
+    indexed = [wavelength for wavelength in bands if wavelength in index.offsets]
+    assert len(indexed) > 0, "none of the wavelengths {} is indexed".format(sorted(bands))
+
+    # intersect the most selective bands
+    indexed.sort(key=lambda wavelength: index.band_count(wavelength, *bands[wavelength]))
+    survivors = np.sort(index.band_ids(indexed[0], *bands[indexed[0]]).astype(np.int64))
+    for wavelength in indexed[1:n_intersect]:
+        if len(survivors) == 0:
+            break
+        survivors = np.intersect1d(survivors, index.band_ids(wavelength, *bands[wavelength]), assume_unique=True)
+    print('{} rows survive the {} most selective bands'.format(len(survivors), min(n_intersect, len(indexed))))
+
+    # check every band on the survivors and rank them by their distance to the centres of the bands
+    key_idx = np.array(sorted(bands), dtype=np.intp)
+    low = np.array([bands[wavelength][0] for wavelength in key_idx])
+    high = np.array([bands[wavelength][1] for wavelength in key_idx])
+    centres = (low + high) / 2
+    top = lookup_helper.TopK(candidate_num)
+    for start in range(0, len(survivors), chunk_size):
+        ids = survivors[start:start + chunk_size]
+        values = library.take(ids)[:, key_idx]
+        inside = np.all((values >= low) & (values <= high), axis=1)
+        top.push(lookup_helper.mse_batch(values[inside], np.arange(len(key_idx)), centres), indices=ids[inside])
+    mses, indices = top.results()
+    return mses, indices, len(survivors)
@@ -0,0 +1,767 @@
+import os
+import json
+import zlib
+import hashlib
+import queue
+import threading
+import numpy as np
+
+# Readers and writers for the spectrum library built by lookup.main(). Two formats are supported:
+#  - the directory of small .npy files written by CnnNetwork.predictBin3(), one file per prediction batch
+#  - one (or a few) large fixed-stride uint8 files described by a json manifest, written by
+#    CnnNetwork.predictBin4(). These are read with np.memmap, so slicing rows is zero-copy and repeated queries
+#    are served by the OS page cache. With layout='column' each file holds a block of rows stored
+#    wavelength-major, so a query that only defines a few keypoints only reads those columns from disk.
+# Both readers expose the same interface (n_rows, spec_len, shards, rows(), take()) so the search code in
+# lookup_helper does not need to know which one it is reading.
+# While a library is being built, every completed shard is recorded with its checksum in an append-only build log,
+# so an interrupted build can be resumed from the first missing row (see lookup.main(resume=True)). The log also
+# records the per-wavelength min/max envelope of each shard, which is saved as the library's zone map so that
+# lookups can skip shards that cannot contain a close enough spectrum (see lookup_helper.shard_bounds()).
+# A library can also carry a pyramid of downsampled copies of its spectra (block means over 4 and 16 wavelengths),
+# each stored as a row-layout library of its own in a subdirectory, which lookup_helper.pyramid_search() ranks
+# before reading the full resolution rows.
+
+MANIFEST_NAME = 'manifest.json'
+BUILD_LOG_NAME = 'build_log.jsonl'
+ZONE_MAP_NAME = 'zone_map.npz'
+PYRAMID_FACTORS = (4, 16)
+FORMAT_VERSION = 1
+
+
+class NpyLibrary(object):
+    """
+    Library stored as the .npy files written by predictBin3(), named test_pred_<model>_NNNNN.npy
+    """
+    def __init__(self, lib_dir):
+        """
+        Index the shards of the library. Only the .npy headers are read, so this is cheap even for tens of
+        thousands of shards
+        :param lib_dir: library directory
+        """
+        self.lib_dir = lib_dir
+        # shards are numbered in grid order by predictBin3(), so sorting the names gives the library order
+        self.shard_paths = [os.path.join(lib_dir, file) for file in sorted(os.listdir(lib_dir))
+                            if file.endswith('.npy')]
+        shard_sizes = []
+        self.spec_len = 0
+        for path in self.shard_paths:
+            with open(path, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, _ = np.lib.format.read_array_header_2_0(f)
+            shard_sizes.append(shape[0])
+            self.spec_len = shape[1]
+        bounds = np.concatenate([[0], np.cumsum(shard_sizes)]).astype(np.int64)
+        self.shard_starts = bounds[:-1]
+        self.n_rows = int(bounds[-1])
+        self.shards = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def rows(self, start, stop):
+        """
+        :return: uint8 array with the spectra of library rows [start, stop)
+        """
+        first = np.searchsorted(self.shard_starts, start, side='right') - 1
+        last = np.searchsorted(self.shard_starts, stop, side='left')
+        if (start, stop) == self.shards[first]:
+            return np.load(self.shard_paths[first])
+        parts = []
+        for shard_id in range(first, last):
+            shard_start, shard_stop = self.shards[shard_id]
+            shard = np.load(self.shard_paths[shard_id], mmap_mode='r')
+            parts.append(shard[max(start, shard_start) - shard_start:min(stop, shard_stop) - shard_start])
+        return np.concatenate(parts)
+
+    def take(self, indices):
+        """
+        :param indices: library rows to fetch
+        :return: uint8 array of shape (len(indices), spec_len)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.shard_starts, indices, side='right') - 1
+        spectra = np.empty((len(indices), self.spec_len), dtype=np.uint8)
+        for shard_id in np.unique(shard_ids):
+            shard = np.load(self.shard_paths[shard_id], mmap_mode='r')
+            pos = np.flatnonzero(shard_ids == shard_id)
+            spectra[pos] = shard[indices[pos] - self.shard_starts[shard_id]]
+        return spectra
+
+
+class MemmapLibrary(object):
+    """
+    Library stored as fixed-stride uint8 files plus a json manifest, see LibraryWriter
+    """
+    def __init__(self, lib_dir):
+        """
+        Read the manifest and memory map the spectrum files
+        :param lib_dir: library directory
+        """
+        self.lib_dir = lib_dir
+        self.manifest = read_manifest(lib_dir)
+        self.model_name = self.manifest['model_name']
+        self.spec_len = self.manifest['spec_len']
+        self.n_rows = self.manifest['n_rows']
+        self.scale = self.manifest['scale']
+        self.layout = self.manifest.get('layout', 'row')
+        self.shards = [tuple(shard) for shard in self.manifest['shards']]
+        self.files = self.manifest['files']
+        self.file_starts = np.array([file['start'] for file in self.files], dtype=np.int64)
+        self.maps = []
+        for file in self.files:
+            rows = file['stop'] - file['start']
+            if rows == 0:  # np.memmap cannot map an empty file
+                self.maps.append(np.empty((0, self.spec_len), dtype=np.uint8))
+            elif self.layout == 'column':
+                # stored as (spec_len, rows), keep the transposed view so rows are still indexed first
+                self.maps.append(np.memmap(os.path.join(lib_dir, file['name']), dtype=np.uint8, mode='r',
+                                           shape=(self.spec_len, rows)).T)
+            else:
+                self.maps.append(np.memmap(os.path.join(lib_dir, file['name']), dtype=np.uint8, mode='r',
+                                           shape=(rows, self.spec_len)))
+
+    def rows(self, start, stop):
+        """
+        :return: uint8 array with the spectra of library rows [start, stop), a view of the memory map if the
+        range lies within a single file. For the column layout the view is wavelength-major, so indexing a few
+        columns of it (as lookup_helper.score_batch() does) only reads those columns from disk
+        """
+        first = np.searchsorted(self.file_starts, start, side='right') - 1
+        last = np.searchsorted(self.file_starts, stop, side='left')
+        parts = []
+        for file_id in range(first, last):
+            file_start = self.files[file_id]['start']
+            file_stop = self.files[file_id]['stop']
+            parts.append(self.maps[file_id][max(start, file_start) - file_start:min(stop, file_stop) - file_start])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def take(self, indices):
+        """
+        :param indices: library rows to fetch
+        :return: uint8 array of shape (len(indices), spec_len)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        file_ids = np.searchsorted(self.file_starts, indices, side='right') - 1
+        spectra = np.empty((len(indices), self.spec_len), dtype=np.uint8)
+        for file_id in np.unique(file_ids):
+            pos = np.flatnonzero(file_ids == file_id)
+            spectra[pos] = self.maps[file_id][indices[pos] - self.file_starts[file_id]]
+        return spectra
+
+
+# map network predictions on [0, 1] to the uint8 values stored in the library
+def quantise(pred_batch, scale=255):
+    """
+    :param pred_batch: float array of predicted spectra, the network occasionally predicts values slightly outside
+    [0, 1], so these are clipped first
+    :param scale: quantisation scale
+    :return: uint8 array of the same shape, round(clip(pred, 0, 1) * scale)
+    """
+    return np.rint(np.clip(pred_batch, a_min=0, a_max=1) * scale).astype(np.uint8)
+
+
+class BackgroundWriter(object):
+    """
+    Runs write calls on a background thread, in the order they are submitted, so the thread driving sess.run()
+    does not wait for the disk. At most max_pending calls are queued, submit() blocks once that many are waiting
+    """
+    def __init__(self, max_pending=8):
+        """
+        Start the writer thread
+        :param max_pending: maximum number of queued calls, bounds the memory held by batches waiting to be written
+        """
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fn, args, kwargs = item
+            # after an error, keep draining the queue so submit() never blocks forever
+            if self.error is None:
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run on the writer thread, raises if a previous call failed
+        """
+        self._check()
+        self.queue.put((fn, args, kwargs))
+
+    def close(self):
+        """
+        Wait until all queued calls have run, raises if one of them failed
+        :return:
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+
+class LibraryWriter(object):
+    """
+    Writes batches of quantised spectra into one or a few large fixed-stride files and records them in a manifest.
+    With layout='column' the rows are buffered until a block of rows_per_file is full, which is then written
+    transposed into its own file and recorded as one shard.
+    Every shard is synced to disk and recorded in the build log as soon as it is written, so with resume=True the
+    writer continues after the last recorded shard of an interrupted build
+    """
+    def __init__(self, lib_dir, model_name, spec_len=300, scale=255, rows_per_file=None, layout='row',
+                 resume=False, pyramid_factors=(), resume_rows=None):
+        """
+        Initialize the writer
+        :param lib_dir: library directory, created if it does not exist
+        :param model_name: name of the model that predicted the spectra
+        :param spec_len: number of points of each spectrum
+        :param scale: quantisation scale, a stored value v corresponds to a transmission of v/scale
+        :param rows_per_file: maximum number of spectra per file, a new file is started once it is reached.
+        For the column layout this is the block size, which is held in memory while it is filled. Defaults to
+        2**24 rows (~5 GB) for the row layout and 2**20 rows (~300 MB) for the column layout
+        :param layout: 'row' to store each spectrum contiguously, 'column' to store each wavelength contiguously
+        :param resume: if True, continue the build recorded in the build log of lib_dir
+        :param pyramid_factors: also write the block means over each of these numbers of wavelengths, see
+        downsample(), as row-layout libraries in the pyramid_NN subdirectories
+        :param resume_rows: with resume, ignore recorded shards beyond this row (used for the pyramid levels, which
+        must not get ahead of their library)
+        """
+        assert layout in ('row', 'column'), "unknown library layout {}".format(layout)
+        self.lib_dir = lib_dir
+        self.model_name = model_name
+        self.spec_len = spec_len
+        self.scale = scale
+        if rows_per_file is None:
+            rows_per_file = 2**20 if layout == 'column' else 2**24
+        self.rows_per_file = rows_per_file
+        self.layout = layout
+        self.block = None
+        self.block_rows = 0
+        self.n_rows = 0
+        self.shards = []
+        self.checksums = []
+        self.zone_mins = []
+        self.zone_maxs = []
+        self.files = []
+        self.file = None
+        if not os.path.exists(lib_dir):
+            os.makedirs(lib_dir)
+        # the manifest is only written once the build is complete
+        if os.path.exists(os.path.join(lib_dir, MANIFEST_NAME)):
+            os.remove(os.path.join(lib_dir, MANIFEST_NAME))
+        header = {'model_name': model_name, 'spec_len': spec_len, 'scale': scale, 'rows_per_file': rows_per_file,
+                  'layout': layout}
+        if resume:
+            self._resume(header, resume_rows)
+        else:
+            start_build_log(lib_dir, header)
+        # every shard is also appended to the pyramid levels, as soon as it is recorded
+        self.levels = []
+        for factor in pyramid_factors:
+            level = LibraryWriter(os.path.join(lib_dir, pyramid_name(factor)), model_name,
+                                  spec_len=(spec_len + factor - 1) // factor, scale=scale,
+                                  rows_per_file=rows_per_file, resume=resume, resume_rows=self.n_rows)
+            if level.n_rows != self.n_rows:
+                print('pyramid level {} is not in step with the library, skipping it. Run build_pyramid() once '
+                      'the build is done'.format(factor))
+                continue
+            self.levels.append((factor, level))
+
+    def _resume(self, header, max_rows=None):
+        old_header, records = resume_build_log(self.lib_dir, max_rows)
+        if old_header is None:
+            start_build_log(self.lib_dir, header)
+            return
+        for key in ('spec_len', 'layout', 'rows_per_file'):
+            assert old_header[key] == header[key], \
+                "cannot resume a build with {}={} as {}={}".format(key, old_header[key], key, header[key])
+        self.shards = [[record['start'], record['stop']] for record in records]
+        self.checksums = [record['crc32'] for record in records]
+        for record in records:
+            self._record_envelope(record)
+        self.n_rows = records[-1]['stop'] if records else 0
+        # files cover fixed row ranges, so they follow from the number of rows written
+        n_files = (self.n_rows + self.rows_per_file - 1) // self.rows_per_file
+        for cnt in range(n_files):
+            self.files.append({'name': file_name(cnt), 'start': cnt * self.rows_per_file,
+                               'stop': min((cnt + 1) * self.rows_per_file, self.n_rows)})
+        if self.layout == 'row' and self.n_rows % self.rows_per_file != 0:
+            # drop whatever was written after the last recorded shard and continue the last file
+            path = os.path.join(self.lib_dir, self.files[-1]['name'])
+            rows = self.files[-1]['stop'] - self.files[-1]['start']
+            os.truncate(path, rows * self.spec_len)
+            self.file = open(path, 'ab')
+        print('resuming library build after {} rows ({} shards)'.format(self.n_rows, len(self.shards)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # a failed build must not look complete, so only a clean exit writes the manifest
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, batch):
+        """
+        Append a batch of spectra to the library, the batch is recorded as one shard in the manifest
+        :param batch: uint8 array of shape (n, spec_len)
+        :return:
+        """
+        assert batch.dtype == np.uint8 and batch.shape[1] == self.spec_len, \
+            "expected uint8 batch of shape (n, {}), got {} {}".format(self.spec_len, batch.dtype, batch.shape)
+        if self.layout == 'column':
+            self._append_column(batch)
+            return
+        written = 0
+        while written < len(batch):
+            if self.file is None or self.files[-1]['stop'] - self.files[-1]['start'] == self.rows_per_file:
+                self._next_file()
+            room = self.rows_per_file - (self.files[-1]['stop'] - self.files[-1]['start'])
+            part = np.ascontiguousarray(batch[written:written + room])
+            self.file.write(part.tobytes())
+            self.files[-1]['stop'] += len(part)
+            written += len(part)
+        self._record_shard(batch)
+
+    def _append_column(self, batch):
+        if self.block is None:
+            self.block = np.empty((self.rows_per_file, self.spec_len), dtype=np.uint8)
+        written = 0
+        while written < len(batch):
+            part = batch[written:written + self.rows_per_file - self.block_rows]
+            self.block[self.block_rows:self.block_rows + len(part)] = part
+            self.block_rows += len(part)
+            written += len(part)
+            if self.block_rows == self.rows_per_file:
+                self._flush_block()
+
+    def _flush_block(self):
+        if self.block_rows == 0:
+            return
+        self._next_file()
+        self.file.write(np.ascontiguousarray(self.block[:self.block_rows].T).tobytes())
+        self.files[-1]['stop'] += self.block_rows
+        self._record_shard(self.block[:self.block_rows])
+        self.block_rows = 0
+
+    # make sure the shard is on disk before it is recorded as complete
+    def _record_shard(self, batch):
+        for factor, level in self.levels:
+            level.append(downsample(batch, factor))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        record = dict({'start': self.n_rows, 'stop': self.n_rows + len(batch), 'crc32': checksum(batch)},
+                      **envelope_record(batch))
+        append_build_log(self.lib_dir, record)
+        self.shards.append([record['start'], record['stop']])
+        self.checksums.append(record['crc32'])
+        self._record_envelope(record)
+        self.n_rows += len(batch)
+
+    def _record_envelope(self, record):
+        # logs written before zone maps existed have no envelopes, the library then gets no zone map
+        if self.zone_mins is not None and 'zone_min' in record:
+            mins, maxs = read_envelope(record)
+            self.zone_mins.append(mins)
+            self.zone_maxs.append(maxs)
+        else:
+            self.zone_mins = self.zone_maxs = None
+
+    def _next_file(self):
+        if self.file is not None:
+            self.file.close()
+        name = file_name(len(self.files))
+        self.file = open(os.path.join(self.lib_dir, name), 'wb')
+        # a batch can span two files, so the new file starts where the last one stopped, not at n_rows
+        start = self.files[-1]['stop'] if self.files else self.n_rows
+        self.files.append({'name': name, 'start': start, 'stop': start})
+
+    def close(self):
+        """
+        Close the current file and write the manifest
+        :return:
+        """
+        if self.layout == 'column':
+            self._flush_block()
+            self.block = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for _, level in self.levels:
+            level.close()
+        write_manifest(self.lib_dir, {'format_version': FORMAT_VERSION,
+                                      'model_name': self.model_name,
+                                      'spec_len': self.spec_len,
+                                      'layout': self.layout,
+                                      'dtype': 'uint8',
+                                      'scale': self.scale,
+                                      'n_rows': self.n_rows,
+                                      'shards': self.shards,
+                                      'checksums': self.checksums,
+                                      'files': self.files})
+        if self.zone_mins is not None:
+            write_zone_map(self.lib_dir, self.shards, self.zone_mins, self.zone_maxs)
+
+    def abort(self):
+        """
+        Close the current file without writing the manifest or the zone map, the shards recorded in the build log
+        so far can be picked up with resume=True
+        :return:
+        """
+        self.block = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for _, level in self.levels:
+            level.abort()
+
+
+def file_name(file_cnt):
+    return 'spectra_{}.bin'.format(str(file_cnt).zfill(5))
+
+
+def checksum(batch):
+    """
+    :param batch: array of spectra
+    :return: crc32 of the array data
+    """
+    return zlib.crc32(np.ascontiguousarray(batch)) & 0xffffffff
+
+
+# per-wavelength min and max of a shard, stored in its build log record as hex strings
+def envelope_record(batch):
+    return {'zone_min': np.min(batch, axis=0).tobytes().hex(), 'zone_max': np.max(batch, axis=0).tobytes().hex()}
+
+
+def read_envelope(record):
+    return (np.frombuffer(bytes.fromhex(record['zone_min']), dtype=np.uint8),
+            np.frombuffer(bytes.fromhex(record['zone_max']), dtype=np.uint8))
+
+
+# the build log is a json line per completed shard, preceded by a header line describing the build
+def start_build_log(lib_dir, header):
+    with open(os.path.join(lib_dir, BUILD_LOG_NAME), 'w') as f:
+        f.write(json.dumps(dict(header, header=True)) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def append_build_log(lib_dir, record):
+    with open(os.path.join(lib_dir, BUILD_LOG_NAME), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_build_log(lib_dir):
+    """
+    :param lib_dir: library directory
+    :return: header of the build log (None if there is no log) and the records of the shards that were completed
+    up to the first missing row, for .npy libraries only those whose file still exists
+    """
+    path = os.path.join(lib_dir, BUILD_LOG_NAME)
+    if not os.path.exists(path):
+        return None, []
+    header = None
+    by_start = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:  # a line cut short by a crash, everything before it is valid
+                break
+            if record.get('header'):
+                header = record
+            else:
+                by_start[record['start']] = record  # a shard rewritten after a resume replaces the old record
+    records = []
+    row = 0
+    while row in by_start:
+        record = by_start[row]
+        if 'name' in record and not os.path.exists(os.path.join(lib_dir, record['name'])):
+            break
+        records.append(record)
+        row = record['stop']
+    return header, records
+
+
+def resume_row(lib_dir):
+    """
+    :param lib_dir: library directory
+    :return: the first library row that an interrupted build still has to predict
+    """
+    _, records = read_build_log(lib_dir)
+    return records[-1]['stop'] if records else 0
+
+
+# read the build log and rewrite it with only the records of the completed rows, before a build is resumed
+def resume_build_log(lib_dir, max_rows=None):
+    header, records = read_build_log(lib_dir)
+    if max_rows is not None:
+        records = [record for record in records if record['stop'] <= max_rows]
+    if header is not None:
+        start_build_log(lib_dir, {key: val for key, val in header.items() if key != 'header'})
+        for record in records:
+            append_build_log(lib_dir, record)
+    return header, records
+
+
+# write a .npy shard atomically and record it in the build log, used by predictBin3()
+def save_shard(lib_dir, name, start, batch):
+    """
+    :param lib_dir: library directory
+    :param name: file name of the shard
+    :param start: library row of the first spectrum of the shard
+    :param batch: uint8 array of spectra
+    :return:
+    """
+    tmp_path = os.path.join(lib_dir, name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, batch, allow_pickle=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(lib_dir, name))
+    record = {'name': name, 'start': start, 'stop': start + len(batch), 'crc32': checksum(batch)}
+    append_build_log(lib_dir, dict(record, **envelope_record(batch)))
+
+
+# write the zone map of a .npy library from the envelopes in its build log, once predictBin3() is done
+def zone_map_from_build_log(lib_dir):
+    _, records = read_build_log(lib_dir)
+    if len(records) == 0 or not all('zone_min' in record for record in records):
+        return False
+    envelopes = [read_envelope(record) for record in records]
+    write_zone_map(lib_dir, [[record['start'], record['stop']] for record in records],
+                   [mins for mins, _ in envelopes], [maxs for _, maxs in envelopes])
+    return True
+
+
+def write_zone_map(lib_dir, shards, mins, maxs):
+    """
+    Save the zone map of a library: the (start, stop) rows of every shard and its per-wavelength min and max
+    :param lib_dir: library directory
+    :param shards: (start, stop) rows of each shard
+    :param mins: uint8 minimum of each shard, shape (n_shards, spec_len)
+    :param maxs: uint8 maximum of each shard, shape (n_shards, spec_len)
+    :return:
+    """
+    tmp_path = os.path.join(lib_dir, ZONE_MAP_NAME + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, shards=np.array(shards, dtype=np.int64).reshape(-1, 2), mins=np.array(mins, dtype=np.uint8),
+                 maxs=np.array(maxs, dtype=np.uint8))
+    os.replace(tmp_path, os.path.join(lib_dir, ZONE_MAP_NAME))
+
+
+def read_zone_map(lib_dir):
+    """
+    :param lib_dir: library directory
+    :return: shards, mins and maxs saved by write_zone_map(), None if the library has no zone map
+    """
+    path = os.path.join(lib_dir, ZONE_MAP_NAME)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as zone_map:
+        return zone_map['shards'], zone_map['mins'], zone_map['maxs']
+
+
+# compute the zone map of a library built before zone maps were recorded
+def build_zone_map(lib_dir):
+    library = open_library(lib_dir)
+    mins = np.empty((len(library.shards), library.spec_len), dtype=np.uint8)
+    maxs = np.empty((len(library.shards), library.spec_len), dtype=np.uint8)
+    for cnt, (start, stop) in enumerate(library.shards):
+        spectra_batch = library.rows(start, stop)
+        mins[cnt] = np.min(spectra_batch, axis=0)
+        maxs[cnt] = np.max(spectra_batch, axis=0)
+        if cnt % 1000 == 0:
+            print('zone map of shard {} of {}'.format(cnt, len(library.shards)))
+    write_zone_map(lib_dir, library.shards, mins, maxs)
+    return lib_dir
+
+
+def verify_library(lib_dir):
+    """
+    Recompute the checksum of every shard of a library and compare it with the one recorded when it was built
+    :param lib_dir: library directory
+    :return: list of the (start, stop) rows of the shards that do not match
+    """
+    library = open_library(lib_dir)
+    if isinstance(library, MemmapLibrary):
+        expected = dict(zip(library.shards, library.manifest.get('checksums', [])))
+    else:
+        _, records = read_build_log(lib_dir)
+        expected = {(record['start'], record['stop']): record['crc32'] for record in records}
+    bad = []
+    for shard in library.shards:
+        if shard not in expected or checksum(library.rows(*shard)) != expected[shard]:
+            bad.append(shard)
+    return bad
+
+
+def read_manifest(lib_dir):
+    with open(os.path.join(lib_dir, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['format_version'] == FORMAT_VERSION, \
+        "unsupported library format version {}".format(manifest['format_version'])
+    return manifest
+
+
+# identifier of the current contents of a library, changes whenever the library is rebuilt, resumed or converted
+def library_id(lib_dir):
+    """
+    Only the size and modification time of the files describing the library are looked at (the manifest and the
+    build log, or for older .npy libraries without either the directory itself, whose modification time changes
+    when shards are added or removed), so this is cheap to call per query. The zone map is part of the id as well,
+    since it decides the order in which the shards are searched
+    :param lib_dir: library directory
+    :return: hex string
+    """
+    paths = [path for path in (os.path.join(lib_dir, MANIFEST_NAME), os.path.join(lib_dir, BUILD_LOG_NAME))
+             if os.path.exists(path)] or [lib_dir]
+    if os.path.exists(os.path.join(lib_dir, ZONE_MAP_NAME)):
+        paths.append(os.path.join(lib_dir, ZONE_MAP_NAME))
+    fingerprint = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps([os.path.abspath(lib_dir), fingerprint]).encode('utf-8')).hexdigest()
+
+
+# write to a temporary file first so that a crash never leaves a half-written manifest behind
+def write_manifest(lib_dir, manifest):
+    tmp_path = os.path.join(lib_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(lib_dir, MANIFEST_NAME))
+
+
+# write one manifest covering the libraries in part_dirs, in order, e.g. the parts of lookup.build_library()
+def assemble_library(lib_dir, part_dirs):
+    """
+    The spectrum files stay where they are, the manifest refers to them by their path relative to lib_dir
+    :param lib_dir: library directory of the assembled library
+    :param part_dirs: library directories of the parts, in library order
+    :return:
+    """
+    manifests = [read_manifest(part_dir) for part_dir in part_dirs]
+    if not os.path.exists(lib_dir):
+        os.makedirs(lib_dir)
+    for key in ('spec_len', 'layout', 'scale', 'model_name'):
+        assert all(manifest.get(key) == manifests[0].get(key) for manifest in manifests), \
+            "cannot assemble parts with different {}".format(key)
+    n_rows = 0
+    files, shards, checksums = [], [], []
+    for part_dir, manifest in zip(part_dirs, manifests):
+        rel_dir = os.path.relpath(part_dir, lib_dir)
+        for file in manifest['files']:
+            files.append({'name': os.path.join(rel_dir, file['name']), 'start': file['start'] + n_rows,
+                          'stop': file['stop'] + n_rows})
+        shards += [[start + n_rows, stop + n_rows] for start, stop in manifest['shards']]
+        checksums += manifest['checksums']
+        n_rows += manifest['n_rows']
+    write_manifest(lib_dir, dict(manifests[0], n_rows=n_rows, shards=shards, checksums=checksums, files=files))
+    for factor in pyramid_levels(part_dirs[0]):
+        level_dirs = [os.path.join(part_dir, pyramid_name(factor)) for part_dir in part_dirs]
+        if all(os.path.exists(os.path.join(level_dir, MANIFEST_NAME)) for level_dir in level_dirs):
+            assemble_library(os.path.join(lib_dir, pyramid_name(factor)), level_dirs)
+    zone_maps = [read_zone_map(part_dir) for part_dir in part_dirs]
+    if all(zone_map is not None for zone_map in zone_maps):
+        write_zone_map(lib_dir, shards, np.concatenate([mins for _, mins, _ in zone_maps]),
+                       np.concatenate([maxs for _, _, maxs in zone_maps]))
+
+
+# block means of a batch of spectra over groups of factor wavelengths, the last group may be shorter
+def downsample(batch, factor):
+    """
+    :param batch: uint8 array of spectra, shape (n, spec_len)
+    :param factor: number of wavelengths per block
+    :return: uint8 array of shape (n, ceil(spec_len / factor))
+    """
+    starts = np.arange(0, batch.shape[1], factor)
+    sums = np.add.reduceat(np.asarray(batch, dtype=np.int32), starts, axis=1)
+    counts = np.diff(np.append(starts, batch.shape[1]))
+    return np.rint(sums / counts).astype(np.uint8)
+
+
+def pyramid_name(factor):
+    return 'pyramid_{}'.format(str(factor).zfill(2))
+
+
+def pyramid_levels(lib_dir):
+    """
+    :param lib_dir: library directory
+    :return: downsampling factors of the complete pyramid levels of the library, finest first
+    """
+    factors = []
+    for name in sorted(os.listdir(lib_dir)):
+        if name.startswith('pyramid_') and os.path.exists(os.path.join(lib_dir, name, MANIFEST_NAME)):
+            factors.append(int(name[len('pyramid_'):]))
+    return sorted(factors)
+
+
+# write the pyramid levels of a library built without them
+def build_pyramid(lib_dir, factors=PYRAMID_FACTORS):
+    library = open_library(lib_dir)
+    writers = [LibraryWriter(os.path.join(lib_dir, pyramid_name(factor)), getattr(library, 'model_name', ''),
+                             spec_len=(library.spec_len + factor - 1) // factor) for factor in factors]
+    for cnt, (start, stop) in enumerate(library.shards):
+        spectra_batch = library.rows(start, stop)
+        for factor, writer in zip(factors, writers):
+            writer.append(downsample(spectra_batch, factor))
+        if cnt % 1000 == 0:
+            print('downsampled shard {} of {}'.format(cnt, len(library.shards)))
+    for writer in writers:
+        writer.close()
+    return lib_dir
+
+
+# libraries are opened once per process, so that worker processes do not re-read the manifest for every shard. Each
+# entry remembers the library_id() it was opened with, so a library that was rebuilt or resumed since is reopened
+_open_libraries = {}
+
+
+def open_library(lib_dir):
+    """
+    Open a library directory in whichever format it was written
+    :param lib_dir: library directory
+    :return: MemmapLibrary if the directory has a manifest, NpyLibrary otherwise
+    """
+    lib_id = library_id(lib_dir)
+    if lib_dir not in _open_libraries or _open_libraries[lib_dir][0] != lib_id:
+        if os.path.exists(os.path.join(lib_dir, MANIFEST_NAME)):
+            _open_libraries[lib_dir] = (lib_id, MemmapLibrary(lib_dir))
+        else:
+            _open_libraries[lib_dir] = (lib_id, NpyLibrary(lib_dir))
+    return _open_libraries[lib_dir][1]
+
+
+# convert a library (in either format) into the memory-mapped format, e.g. the .npy files from predictBin3()
+def convert_library(src_dir, lib_dir, model_name, rows_per_file=None, layout='row', pyramid_factors=()):
+    src_library = open_library(src_dir)
+    with LibraryWriter(lib_dir, model_name, spec_len=src_library.spec_len, rows_per_file=rows_per_file,
+                       layout=layout, pyramid_factors=pyramid_factors) as writer:
+        for cnt, (start, stop) in enumerate(src_library.shards):
+            writer.append(np.ascontiguousarray(src_library.rows(start, stop)))
+            if cnt % 1000 == 0:
+                print('converted shard {} of {}'.format(cnt, len(src_library.shards)))
+    return lib_dir
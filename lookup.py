@@ -7,54 +7,73 @@ import time
 import utils
 import network_maker
 import network_helper
+import data_reader
 import matplotlib
 import matplotlib.pyplot as plt
-matplotlib.use('TkAgg')
 from itertools import islice
-import struct
 import pickle
+import json
+import resource
+import multiprocessing
+
+import lookup_helper
+import library_helper
+import grid_helper
+import numpy_network
+import index_helper
+import ann_helper
+
+# inference settings chosen by tune_inference(), saved in the model directory
+INFERENCE_CONFIG_NAME = 'inference_config.json'
+
 
 # generate geometric parameters for the grid and save them in a file
-def gen_data(out_path, param_bounds, spacings):
-    scan = []
-    for h1 in np.arange(param_bounds[0, 0], param_bounds[0, 1], spacings[0]):
-        scan.append(h1)
-    print('possible h1 values are in {}'.format(scan))
-    print('if all bounds and spacings are the same, number of combos is {}'.format(len(scan)**8))
+def gen_data(out_path, param_bounds, spacings, block_rows=2**22, n_workers=1):
+    """
+    Write the grid as binary blocks of geometries (grid_NNNNN.npy, float32, 8 parameters + 16 ratios per row)
+    along with its grid.json descriptor. Rerunning it resumes from the blocks that are missing
+    :param out_path: output directory
+    :param param_bounds: array of shape (8, 2) with the [low, high) bounds of h1..h4, r1..r4
+    :param spacings: spacing of each parameter
+    :param block_rows: number of grid rows per block file
+    :param n_workers: number of worker processes computing blocks
+    :return:
+    """
+    grid = grid_helper.GridDescriptor(param_bounds, spacings)
+    print('possible h1 values are in {}'.format(grid.values[0]))
+    print('number of combos is {}'.format(grid.n_rows))
     start = time.time()
-    with open(os.path.join(out_path, 'grid.csv'), 'w+') as gfile:
-        for h1 in np.arange(param_bounds[0, 0], param_bounds[0, 1], spacings[0]):
-            for h2 in np.arange(param_bounds[1, 0], param_bounds[1, 1], spacings[1]):
-                check_time = time.time()
-                print('time elapsed: {}'.format(np.round(check_time-start), 1))
-                print('h1 = {}, h2 = {}'.format(h1, h2))
-                for h3 in np.arange(param_bounds[2, 0], param_bounds[2, 1], spacings[2]):
-                    for h4 in np.arange(param_bounds[3, 0], param_bounds[3, 1], spacings[3]):
-                        for r1 in np.arange(param_bounds[4, 0], param_bounds[4, 1], spacings[4]):
-                            for r2 in np.arange(param_bounds[5, 0], param_bounds[5, 1], spacings[5]):
-                                for r3 in np.arange(param_bounds[6, 0], param_bounds[6, 1], spacings[6]):
-                                    for r4 in np.arange(param_bounds[7, 0], param_bounds[7, 1], spacings[7]):
-                                        geom_params = np.round([h1, h2, h3, h4,
-                                                                r1, r2, r3, r4,
-                                                                r1/h1, r2/h1, r3/h1, r4/h1,
-                                                                r1/h2, r2/h2, r3/h2, r4/h2,
-                                                                r1/h3, r2/h3, r3/h3, r4/h3,
-                                                                r1/h4, r2/h4, r3/h4, r4/h4], 1)
-                                        geom_strs = [str(el) for el in geom_params]
-                                        gfile.write(",".join(geom_strs) + '\n')
+    grid_helper.write_grid(out_path, param_bounds, spacings, block_rows=block_rows, n_workers=n_workers)
     finish = time.time()
     print('total time taken = {}'.format(finish-start))
 
+
+# geometries of library rows: decoded from the grid descriptor if the grid has one, otherwise read from grid.csv
+def candidate_geometries(spec_indices, geometries_path, lib_dir):
+    grid_rows = np.array(spec_indices, dtype=np.int64) - 1
+    grid = grid_helper.find_grid(lib_dir, geometries_path)
+    if grid is not None:
+        geoms = grid.geometry(grid_rows)
+    else:
+        geoms = grid_helper.read_grid_rows(geometries_path, grid_rows)
+    return geoms.tolist()
+
+
 # yield the geometry from the saved grid data file in the form of a dataset
-def import_data(data_dir, batch_size=100):
+def import_data(data_dir, batch_size=100, skip=0, count=None, prefetch=2):
     """
     :param data_dir:
     :param grid_dir:
+    :param skip: number of geometries to skip at the start, used to resume a library build
+    :param count: number of geometries to yield after skip, all of them if None
+    :param prefetch: number of batches prepared ahead of the network
     :return: returns a dataset which can yield all the input data
     """
 
-    # define input and output files
-    data_paths = [os.path.join(data_dir, file) for file in os.listdir(data_dir) if file.endswith(".csv")]
+    # define input and output files, binary grid blocks from gen_data() take precedence over csv files
+    data_paths = [os.path.join(data_dir, file) for file in sorted(os.listdir(data_dir)) if file.endswith(".npy")]
+    if len(data_paths) == 0:
+        data_paths = [os.path.join(data_dir, file) for file in sorted(os.listdir(data_dir)) if file.endswith(".csv")]
 
     # pull data into python, should be either for training set or eval set
     print(data_paths)
@@ -62,6 +81,10 @@ def import_data(data_dir, batch_size=100):
     def get_geom(data_paths):
         for file_name in data_paths:
             print('getting geom from file {}'.format(file_name))
+            if file_name.endswith('.npy'):
+                for geom in np.load(file_name):
+                    yield geom
+                continue
             with open(file_name, 'r') as file:
                 for line in file:
                     geom = line.split(",")  # [2:26] if using validation set for testing
@@ -72,8 +95,51 @@ def import_data(data_dir, batch_size=100):
     ds = tf.data.Dataset.from_generator(lambda: get_geom(data_paths), (tf.float32),
                                         (tf.TensorShape([24]))
                                         )
-    # shuffle then split into training and validation sets
-    ds = ds.batch(batch_size, drop_remainder=True)
+    ds = ds.skip(skip)
+    if count is not None:
+        ds = ds.take(count)
+    # the graph takes any batch size, so the last partial batch of geometries is kept
+    ds = ds.batch(batch_size)
+    ds = ds.prefetch(prefetch)
+
+    iterator = ds.make_one_shot_iterator()
+    features = iterator.get_next()
+    pred_init_op = iterator.make_initializer(ds)
+
+    return features, pred_init_op
+
+
+# yield the geometries of grid rows [start, stop) computed in the graph from their row index, instead of parsing
+# them from grid.csv
+def import_grid(grid, batch_size=100, start=0, stop=None, prefetch=2):
+    """
+    :param grid: grid_helper.GridDescriptor of the grid
+    :param batch_size: batch size
+    :param start: first grid row
+    :param stop: last grid row (exclusive), defaults to the end of the grid
+    :param prefetch: number of batches prepared ahead of the network
+    :return: returns a dataset which can yield all the input data, the same values as import_data() on grid.csv
+    """
+    if stop is None:
+        stop = grid.n_rows
+    # mixed-radix decoding, h1 is the outermost parameter of the lattice and r4 the innermost
+    strides = [int(np.prod(grid.shape[cnt + 1:], dtype=np.int64)) for cnt in range(len(grid.shape))]
+    param_values = [tf.constant(values, dtype=tf.float64) for values in grid.values]
+
+    def get_geom(indices):
+        params = []
+        for values, stride, size in zip(param_values, strides, grid.shape):
+            params.append(tf.gather(values, (indices // stride) % size))
+        params = tf.stack(params, axis=1)
+        # the 16 ratios r_j/h_i, in the order gen_data() writes them, then round like gen_data() does
+        ratios = params[:, tf.newaxis, 4:8] / params[:, 0:4, tf.newaxis]
+        geom = tf.concat([params, tf.reshape(ratios, [-1, 16])], axis=1)
+        return tf.cast(tf.round(geom * 10) / 10, tf.float32)
+
+    ds = tf.data.Dataset.range(start, stop)
+    ds = ds.batch(batch_size)
+    ds = ds.map(get_geom)
+    ds = ds.prefetch(prefetch)
 
     iterator = ds.make_one_shot_iterator()
     features = iterator.get_next()
@@ -83,14 +149,43 @@ def import_data(data_dir, batch_size=100):
 
 
 # generate predictions with the given model and save them to a spectrum library file
-def main(data_dir, lib_dir, model_name, batch_size=10):
+def main(data_dir, lib_dir, model_name, batch_size=None, lib_format='npy', use_grid=True, resume=False,
+         start=0, stop=None, session_config=None, prefetch=None, pyramid_factors=library_helper.PYRAMID_FACTORS):
     ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
     clip, fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch, \
     reg_scale = network_helper.get_parameters(ckpt_dir)
+    # settings that are not given come from the configuration saved by tune_inference(), if the model has one
+    tuned = load_inference_config(ckpt_dir)
+    if batch_size is None:
+        batch_size = tuned.get('batch_size', 10)
+    if prefetch is None:
+        prefetch = tuned.get('prefetch', 2)
+    if session_config is None and 'intra_threads' in tuned:
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=tuned['intra_threads'],
+                                        inter_op_parallelism_threads=tuned['inter_threads'])
+    print('batch size {}, prefetch {}'.format(batch_size, prefetch))
+
+    print('defining save file')
+    save_file = os.path.join('.', lib_dir)
+    if not os.path.exists(save_file):
+        os.makedirs(save_file)
+    # an interrupted build continues from the first row missing from its build log
+    start_row = start + (library_helper.resume_row(save_file) if resume else 0)
+    if start_row > start:
+        print('resuming library build at grid row {}'.format(start_row))
 
     print('defining input data')
-    features, pred_init_op = import_data(data_dir=data_dir,
-                                         batch_size=batch_size)
+    # if the grid has a descriptor, generate the geometries in the graph rather than parsing grid.csv
+    grid = grid_helper.find_grid(data_dir)
+    if use_grid and grid is not None:
+        features, pred_init_op = import_grid(grid, batch_size=batch_size, start=start_row, stop=stop,
+                                             prefetch=prefetch)
+    else:
+        features, pred_init_op = import_data(data_dir=data_dir,
+                                             batch_size=batch_size,
+                                             skip=start_row,
+                                             count=None if stop is None else stop - start_row,
+                                             prefetch=prefetch)
 
     print('making network')
     # make network
@@ -99,56 +194,316 @@ def main(data_dir, lib_dir, model_name, batch_size=10):
                                     n_filter=n_filter, n_branch=n_branch, reg_scale=reg_scale,
                                     tconv_filters=tconv_filters, make_folder=False)
 
-    print('defining save file')
-    save_file = os.path.join('.', lib_dir)
+    # keep the grid descriptor next to the library, so lookups can recover geometries from row indices
+    if grid is not None:
+        grid.save(save_file)
 
     # evaluate the model for each geometry in the grid file
     print('executing the model ...')
-    pred_file = ntwk.predictBin3(pred_init_op, ckpt_dir=ckpt_dir, model_name=model_name, save_file=save_file)
+    # 'npy' writes one .npy file per batch, 'memmap' one large memory-mappable file plus a manifest and 'column'
+    # the same, but stored wavelength-major for queries that only define a few keypoints
+    if lib_format in ('memmap', 'column'):
+        pred_file = ntwk.predictBin4(pred_init_op, ckpt_dir=ckpt_dir, model_name=model_name, save_file=save_file,
+                                     layout='column' if lib_format == 'column' else 'row', resume=resume,
+                                     config=session_config, pyramid_factors=pyramid_factors)
+    else:
+        pred_file = ntwk.predictBin3(pred_init_op, ckpt_dir=ckpt_dir, model_name=model_name, save_file=save_file,
+                                     resume=resume, config=session_config)
+        # the .npy files are written by a background thread of predictBin3(), downsample them once they are done
+        if pyramid_factors:
+            library_helper.build_pyramid(save_file, pyramid_factors)
     return pred_file
 
+
+# build one part of the library in its own process, used by build_library()
+def build_library_part(task):
+    part_dir, start, stop, intra_threads, inter_threads, kwargs = task
+    # pin the thread pools, so that the workers share the cores instead of each trying to use all of them
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads, inter_op_parallelism_threads=inter_threads)
+    tf.reset_default_graph()
+    return main(lib_dir=part_dir, start=start, stop=stop, session_config=config, **kwargs)
+
+
+# generate the library with several processes, each predicting its own range of grid rows into a part of the library
+def build_library(data_dir, lib_dir, model_name, n_workers, batch_size=None, lib_format='memmap', resume=False,
+                  intra_threads=None, inter_threads=1):
+    """
+    :param data_dir: grid directory, it needs a grid descriptor (see gen_data())
+    :param lib_dir: library directory, the parts are written to lib_dir/part_NN and assembled into one manifest
+    :param model_name: name of the model
+    :param n_workers: number of worker processes
+    :param batch_size: prediction batch size of each worker, defaults to the one saved by tune_inference()
+    :param lib_format: 'memmap' or 'column'
+    :param resume: continue an interrupted build, each part resumes from its own build log
+    :param intra_threads: intra-op threads of each worker, defaults to an equal share of the cores
+    :param inter_threads: inter-op threads of each worker
+    :return: lib_dir
+    """
+    assert lib_format in ('memmap', 'column'), "parallel builds write the memmap format, got {}".format(lib_format)
+    grid = grid_helper.find_grid(data_dir)
+    assert grid is not None, "parallel builds need a grid descriptor in {}".format(data_dir)
+    if intra_threads is None:
+        intra_threads = max(1, os.cpu_count() // n_workers)
+    if batch_size is None:
+        ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
+        batch_size = load_inference_config(ckpt_dir).get('batch_size', 10)
+
+    # split the grid into n_workers contiguous ranges of whole batches
+    n_batches = (grid.n_rows + batch_size - 1) // batch_size
+    bounds = [min(grid.n_rows, (cnt * n_batches // n_workers) * batch_size) for cnt in range(n_workers + 1)]
+    part_dirs = [os.path.join(lib_dir, 'part_{}'.format(str(cnt).zfill(2))) for cnt in range(n_workers)]
+    kwargs = {'data_dir': data_dir, 'model_name': model_name, 'batch_size': batch_size, 'lib_format': lib_format,
+              'resume': resume}
+    tasks = [(part_dir, start, stop, intra_threads, inter_threads, kwargs)
+             for part_dir, start, stop in zip(part_dirs, bounds[:-1], bounds[1:])]
+
+    # spawn fresh processes rather than forking this one, tensorflow does not survive a fork
+    start_time = time.time()
+    pool = multiprocessing.get_context('spawn').Pool(n_workers, maxtasksperchild=1)
+    try:
+        pool.map(build_library_part, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print('all {} parts done, time taken is {}'.format(n_workers, np.round(time.time() - start_time)))
+
+    library_helper.assemble_library(lib_dir, part_dirs)
+    grid.save(lib_dir)
+    return lib_dir
+
+
+# inference settings saved by tune_inference(), an empty dict if the model has not been tuned
+def load_inference_config(ckpt_dir):
+    config_file = os.path.join(ckpt_dir, INFERENCE_CONFIG_NAME)
+    if not os.path.exists(config_file):
+        return {}
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+
+# time the model on one combination of inference settings, run in a fresh process by tune_inference() so that
+# every trial gets its own tensorflow thread pools and its own memory peak
+def tune_trial(task):
+    """
+    :param task: tuple of (grid directory, model name, batch size, intra-op threads, inter-op threads, prefetch
+    depth, number of batches to time)
+    :return: dict with the settings, the spectra predicted per second and the peak resident memory in MB
+    """
+    data_dir, model_name, batch_size, intra_threads, inter_threads, prefetch, n_batches = task
+    ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
+    clip, fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch, \
+    reg_scale = network_helper.get_parameters(ckpt_dir)
+    grid = grid_helper.find_grid(data_dir)
+
+    tf.reset_default_graph()
+    # one extra batch to warm up the session
+    features, pred_init_op = import_grid(grid, batch_size=batch_size, stop=min(grid.n_rows,
+                                                                              batch_size * (n_batches + 1)),
+                                         prefetch=prefetch)
+    ntwk = network_maker.CnnNetwork(features, [], utils.my_model_fn_tens, batch_size, clip=clip,
+                                    fc_filters=fc_filters, tconv_Fnums=tconv_Fnums, tconv_dims=tconv_dims,
+                                    n_filter=n_filter, n_branch=n_branch, reg_scale=reg_scale,
+                                    tconv_filters=tconv_filters, make_folder=False)
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads, inter_op_parallelism_threads=inter_threads)
+    with tf.Session(config=config) as sess:
+        ntwk.load(sess, ckpt_dir)
+        sess.run(pred_init_op)
+        sess.run(ntwk.logits)
+        row_cnt = 0
+        start = time.time()
+        try:
+            while True:
+                row_cnt += len(sess.run(ntwk.logits))
+        except tf.errors.OutOfRangeError:
+            elapsed = time.time() - start
+    # ru_maxrss is in kB on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'batch_size': batch_size, 'intra_threads': intra_threads, 'inter_threads': inter_threads,
+            'prefetch': prefetch, 'spectra_per_sec': row_cnt / max(elapsed, 1e-9), 'peak_mb': peak_mb}
+
+
+def tune_inference(data_dir, model_name, batch_sizes=(1000, 5000, 20000, 50000), thread_settings=None,
+                   prefetch_depths=(1, 2, 4), n_batches=5, max_memory_mb=None):
+    """
+    Sweep the inference settings of a model on the rows of a grid and save the fastest combination next to the
+    checkpoint, where main() and build_library() pick it up
+    :param data_dir: grid directory, it needs a grid descriptor (see gen_data())
+    :param model_name: name of the model
+    :param batch_sizes: batch sizes to try
+    :param thread_settings: (intra-op, inter-op) thread counts to try, defaults to a few splits of the cores
+    :param prefetch_depths: prefetch depths to try
+    :param n_batches: number of batches timed in each trial
+    :param max_memory_mb: if given, ignore combinations whose peak memory exceeds it
+    :return: the best trial, see tune_trial()
+    """
+    assert grid_helper.find_grid(data_dir) is not None, "tuning needs a grid descriptor in {}".format(data_dir)
+    if thread_settings is None:
+        n_cores = os.cpu_count()
+        thread_settings = sorted({(n_cores, 1), (n_cores, 2), (max(1, n_cores // 2), 2)})
+    tasks = [(data_dir, model_name, batch_size, intra_threads, inter_threads, prefetch, n_batches)
+             for batch_size in batch_sizes
+             for intra_threads, inter_threads in thread_settings
+             for prefetch in prefetch_depths]
+
+    # one fresh process per trial, tensorflow fixes its thread pools when the first session starts
+    trials = []
+    pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+    try:
+        for trial in pool.imap(tune_trial, tasks, chunksize=1):
+            print('batch {batch_size}, threads {intra_threads}/{inter_threads}, prefetch {prefetch}: '
+                  '{spectra_per_sec:.0f} spectra/s, peak memory {peak_mb:.0f} MB'.format(**trial))
+            trials.append(trial)
+    finally:
+        pool.close()
+        pool.join()
+
+    candidates = [trial for trial in trials if max_memory_mb is None or trial['peak_mb'] <= max_memory_mb]
+    assert len(candidates) > 0, "no combination fits in {} MB".format(max_memory_mb)
+    best = dict(max(candidates, key=lambda trial: trial['spectra_per_sec']))
+    best['trials'] = trials
+    ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
+    with open(os.path.join(ckpt_dir, INFERENCE_CONFIG_NAME), 'w') as f:
+        json.dump(best, f, indent=1)
+    print('best: batch {batch_size}, threads {intra_threads}/{inter_threads}, prefetch {prefetch}, '
+          '{spectra_per_sec:.0f} spectra/s'.format(**best))
+    return best
+
+
+# export the weights of a model for numpy_network.NumpyNetwork and check that it reproduces the tensorflow
+# predictions on the first n_batches batches of the grid
+def compare_numpy_network(data_dir, model_name, batch_size=100, n_batches=10):
+    """
+    :param data_dir: grid directory
+    :param model_name: name of the model
+    :param batch_size: batch size
+    :param n_batches: number of batches to compare
+    :return: the largest absolute difference between the two predictions
+    """
+    ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
+    clip, fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch, \
+    reg_scale = network_helper.get_parameters(ckpt_dir)
+    weights_file = network_helper.export_weights(ckpt_dir)
+
+    grid = grid_helper.find_grid(data_dir)
+    if grid is not None:
+        features, pred_init_op = import_grid(grid, batch_size=batch_size, stop=batch_size * n_batches)
+    else:
+        features, pred_init_op = import_data(data_dir=data_dir, batch_size=batch_size, count=batch_size * n_batches)
+    ntwk = network_maker.CnnNetwork(features, [], utils.my_model_fn_tens, batch_size, clip=clip,
+                                    fc_filters=fc_filters, tconv_Fnums=tconv_Fnums, tconv_dims=tconv_dims,
+                                    n_filter=n_filter, n_branch=n_branch, reg_scale=reg_scale,
+                                    tconv_filters=tconv_filters, make_folder=False)
+    np_ntwk = numpy_network.NumpyNetwork(weights_file)
+
+    max_diff = 0
+    with tf.Session() as sess:
+        ntwk.load(sess, ckpt_dir)
+        sess.run(pred_init_op)
+        try:
+            while True:
+                geoms, pred_batch = sess.run([features, ntwk.logits])
+                max_diff = max(max_diff, np.max(np.abs(np_ntwk.predict(geoms) - pred_batch)))
+        except tf.errors.OutOfRangeError:
+            pass
+    print('largest difference between the tensorflow and numpy predictions: {}'.format(max_diff))
+    return max_diff
+
+
+# numpy forward pass of a trained model, the weights are exported from its checkpoint on first use
+def load_numpy_network(model_name):
+    ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', model_name)
+    if not os.path.exists(os.path.join(ckpt_dir, numpy_network.WEIGHTS_NAME)):
+        network_helper.export_weights(ckpt_dir)
+    return numpy_network.NumpyNetwork(ckpt_dir)
+
+
+# generate the library with numpy_network instead of tensorflow
+def main_numpy(data_dir, lib_dir, model_name, batch_size=4096, layout='row', resume=False, start=0, stop=None,
+               pyramid_factors=library_helper.PYRAMID_FACTORS):
+    """
+    :param data_dir: grid directory, it needs a grid descriptor (see gen_data())
+    :param lib_dir: library directory, written in the memmap format
+    :param model_name: name of the model, its weights are exported first if they have not been
+    :param batch_size: number of geometries per forward pass
+    :param layout: 'row' or 'column', see library_helper.LibraryWriter
+    :param resume: continue an interrupted build from its build log
+    :param start: first grid row
+    :param stop: last grid row (exclusive), defaults to the end of the grid
+    :param pyramid_factors: downsampling factors of the pyramid levels written with the library
+    :return: lib_dir
+    """
+    network = load_numpy_network(model_name)
+    grid = grid_helper.find_grid(data_dir)
+    assert grid is not None, "numpy library builds need a grid descriptor in {}".format(data_dir)
+    if stop is None:
+        stop = grid.n_rows
+
+    start_row = start + (library_helper.resume_row(lib_dir) if resume else 0)
+    if start_row > start:
+        print('resuming library build at grid row {}'.format(start_row))
+    spec_len = network.tconv_dims[-1] - 2 * network.clip
+    start_time = time.time()
+    with library_helper.LibraryWriter(lib_dir, model_name, spec_len=spec_len, layout=layout, resume=resume,
+                                      pyramid_factors=pyramid_factors) as lib_writer, \
+            library_helper.BackgroundWriter() as writer:
+        for batch_start in range(start_row, stop, batch_size):
+            # geometries as float32, the same values the tensorflow input pipeline feeds the network
+            geoms = grid.geometry(np.arange(batch_start, min(batch_start + batch_size, stop), dtype=np.int64))
+            pred_batch = network.forward(geoms.astype(np.float32))
+            writer.submit(lib_writer.append, library_helper.quantise(pred_batch))
+    grid.save(lib_dir)
+    print('predicted grid rows {} to {}, time taken is {}'.format(start_row, stop, np.round(time.time() - start_time)))
+    return lib_dir
+
+
+# report the spectral error the reduced precision modes of numpy_network would add relative to float32 on the eval set
+def precision_report(model_name, data_dir=os.path.join('.', 'dataGrid', 'gridFiles'),
+                     eval_dir=os.path.join('.', 'dataIn', 'eval'), calib_size=4096):
+    """
+    :param model_name: name of the model
+    :param data_dir: grid directory, the int8 weights are calibrated on grid rows if it has a grid descriptor
+    :param eval_dir: directory of the eval set csv files, the errors are reported on its geometries
+    :param calib_size: number of grid rows, spread over the whole grid, used to calibrate the int8 weights
+    :return: list with one dict of errors per precision, see numpy_network.precision_error()
+    """
+    network = load_numpy_network(model_name)
+    features, _ = data_reader.importData(eval_dir, x_range=range(2, 10 + 16), y_range=range(10 + 16, 2011 + 16))
+    grid = grid_helper.find_grid(data_dir)
+    calib_features = None
+    if grid is not None:
+        calib_features = grid.geometry(np.linspace(0, grid.n_rows - 1, calib_size).astype(np.int64))
+
+    report = [numpy_network.precision_error(network, features, precision, calib_features=calib_features)
+              for precision in numpy_network.PRECISIONS[1:]]
+    print('{:>10} {:>12} {:>12} {:>16} {:>14}'.format('precision', 'max error', 'mean error', 'max uint8 error',
+                                                      'uint8 changed'))
+    for errors in report:
+        print('{precision:>10} {max_error:>12.3E} {mean_error:>12.3E} {max_uint8_error:>16} '
+              '{uint8_changed:>14.3%}'.format(**errors))
+    return report
+
+
 def lookup(sstar, library_path, candidate_num):
-    candidates = []
+    top = lookup_helper.TopK(candidate_num)
     start = time.time()
     # extract the defined points of sstar
-    sstar_keyPoints = []
-    for cnt, value in enumerate(sstar):
-        if value is not None:
-            sstar_keyPoints.append([cnt, value])
+    key_idx, key_val = lookup_helper.get_keypoints(sstar, dtype=np.float64)
+    sstar_keyPoints = list(zip(key_idx, key_val))
 
     with open(library_path) as lib:
         line_batch = islice(lib, 100)
-        for line in line_batch:
-            # line_start = time.time()
-            # if cnt != 0 and (cnt % 1000) == 0:
-            #     print('line is {}, time taken is {}'.format(cnt, np.round(time.time()-start, 3)))
-
-            # get spectrum from library file
-            spectrum = line.split(',')
-            spectrum = [float(string) for string in spectrum]
-            assert len(spectrum) == 300
-
-            # calculate mse with desired spectrum
-            errors = []
-
-            for index, value in sstar_keyPoints:
-                errors.append((spectrum[index] - value) ** 2)
-            mse = np.mean(errors)
-
-            if len(candidates) < candidate_num:  # then we need more candidates, so append
-                candidates.append([spectrum, mse])
-            else:  # see if this spectrum is better than any of the current candidates
-                for candidate in candidates:
-                    if candidate[1] > mse:
-                        candidates.append([spectrum, mse])
-                        candidates.sort(key=lambda x: x[1])
-                        candidates = candidates[:candidate_num]  # take only the candidates with the lowest error
-                        break
+        # get spectra from library file
+        spectra = np.array([[float(string) for string in line.split(',')] for line in line_batch])
+        assert spectra.shape[1] == 300
 
+        # calculate mse with desired spectrum
+        top.push(lookup_helper.mse_batch(spectra, key_idx, key_val))
+
+    mses, indices = top.results()
+    candidates = lookup_helper.candidate_array(spectra[indices], mses)
     print('total search time taken is {}'.format(np.round(time.time() - start, 4)))
     #convert to arrays so we can slice
     sstar_keyPoints = np.array(sstar_keyPoints)
-    candidates = np.array(candidates)
     # plot the defined sstar points along with the candidate
     plt.scatter(sstar_keyPoints[:, 0],
                 sstar_keyPoints[:, 1])
@@ -158,87 +513,42 @@ def lookup(sstar, library_path, candidate_num):
     return candidates
 
 def lookupBin(sstar, lib_dir, geometries_path, candidate_num):
-    candidates = []
+    top = lookup_helper.TopK(candidate_num)
     start = time.time()
 
-
     # extract the keypoints from sstar
-    sstar_keyPoints = []
-    for starcnt, value in enumerate(sstar):  # extract the defined points of sstar
-        if value is not None:
-            sstar_keyPoints.append((starcnt, value))
-
-    # make generator for bytes from a file to be read
-    def byte_yield(f, byte_num):
-        dat = 'x'
-        while dat:
-            dat = f.read(byte_num)
-            if dat:
-                yield dat
-            else:
-                break
-    batch_cnt = 0
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    sstar_keyPoints = list(zip(key_idx, key_val))
+
     spec_cnt = 0
-    simult_spectra = 2  # the number of spectra to read from the file at a time
+    simult_spectra = 20000  # the number of spectra to read from the file at a time
     with open(lib_dir, 'rb') as lib:
-        structobj = struct.Struct('B'*(300*simult_spectra))
-        for byte_set in byte_yield(lib, byte_num=300*simult_spectra):  # needs exact length of a spectrum
-            spectrum_batch = structobj.unpack(byte_set)  # unpack a single unsigned char to [0, 255]
-            batch_cnt += 1
-
-            # yield a single spectrum from the batch
-            def spec_chunk(l, n):
-                for i in range(0, len(l), n):
-                    yield l[i: i + n]
-
-            # consider each spectrum in the batch one at a time
-            for spectrum in spec_chunk(spectrum_batch, 300):
-                spec_cnt += 1
-                # convert back to floats on [0, 1]
-                assert len(spectrum) == 300
-
-                # calculate mse with desired spectrum
-                errors = []
-                for index, value in sstar_keyPoints:
-                    errors.append((spectrum[index]-value)**2)
-                mse = np.mean(errors)
-
-                if len(candidates) < candidate_num:  # then we need more candidates, so append
-                    candidates.append([spectrum, mse, spec_cnt])
-                else:  # see if this spectrum is better than any of the current candidates
-                    for candidate in candidates:
-                        if candidate[1] > mse:
-                            candidates.append([spectrum, mse, spec_cnt])
-                            candidates.sort(key=lambda x: x[1])
-                            candidates = candidates[:candidate_num]  # take only the candidates with the lowest error
-                            break
+        while True:
+            byte_set = lib.read(300*simult_spectra)  # needs exact length of a spectrum
+            if not byte_set:
+                break
+            spectrum_batch = np.frombuffer(byte_set, dtype=np.uint8).reshape(-1, 300)
+
+            # score the whole batch at once, keeping only the best candidate_num (mse, index) pairs
+            top.push(lookup_helper.mse_batch(spectrum_batch, key_idx, key_val), offset=spec_cnt)
+            spec_cnt += len(spectrum_batch)
+
+        # only now read the spectra of the final candidates back from the library
+        mses, indices = top.results()
+        spectra = []
+        for index in indices:
+            lib.seek(300*index)
+            spectra.append(np.frombuffer(lib.read(300), dtype=np.uint8))
 
     print('total search time taken is {}'.format(np.round(time.time() - start, 4)))
     #convert to arrays so we can slice
     sstar_keyPoints = np.array(sstar_keyPoints)
-    candidates = np.array(candidates)
+    candidates = lookup_helper.candidate_array(spectra, mses, indices + 1)
 
-    # get the geometric values from the file of features
+    # get the geometric values of the candidates, spec_indices are 1-based grid rows
     spec_indices = candidates[:, 2]
     print('spec_indices are {}'.format(spec_indices))
-    geom_strings = []
-    geom_cnt = 0
-    with open(geometries_path, 'r') as geom_file:
-        for line in geom_file:
-            geom_cnt += 1
-            if geom_cnt in spec_indices:
-                geom_strings.append(line)
-                if len(geom_strings) == len(candidates):
-                    break
-    geom_strings_split = [geometries.split(',') for geometries in geom_strings]
-    geoms = []
-    for geom_set in geom_strings_split:
-        geoms.append([float(string) for string in geom_set])
-
-    # rearrange geom elements so that they match the order of candidates (sorted by MSE)
-    indices=sorted(range(len(candidates)), key=lambda k: candidates[k, 2])
-    geoms = [geoms[i] for i in indices]
-    print('geom_cnt is {}'.format(geom_cnt))
+    geoms = candidate_geometries(spec_indices, geometries_path, lib_dir)
     print('geometries are {}'.format(np.array(geoms)))
 
     # plot the defined sstar points along with the candidate
@@ -250,84 +560,76 @@ def lookupBin(sstar, lib_dir, geometries_path, candidate_num):
     return candidates, geoms
 
 
-# rewrite for multi-file format (predictBin3() )
-def lookupBin2(sstar, lib_dir, geometries_path, candidate_num, threshold, min_dist):
-    candidates = []
+# rewrite for multi-file format (predictBin3() ), the scan itself is lookup_helper.iter_search()
+def lookupBin2(sstar, lib_dir, geometries_path, candidate_num, threshold, min_dist, n_workers=1, use_zone_map=True,
+               cache=None, max_rows=212089987, max_seconds=None, constraints=None):
+    """
+    :param sstar: target spectrum, a list with None at every undefined wavelength
+    :param lib_dir: library directory
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param candidate_num: number of candidates to return
+    :param threshold: stop as soon as the best mse is below threshold
+    :param min_dist: minimum euclidean distance between two candidates (library units), 0 for a plain top k
+    :param n_workers: number of worker processes
+    :param use_zone_map: order and skip the shards with the zone map of the library
+    :param cache: query_cache.QueryCache answering repeated queries
+    :param max_rows: stop after this many spectra, the default is ~26% of the full library, None scans everything
+    :param max_seconds: wall-clock budget of the scan in seconds, no limit if None
+    :param constraints: only search the geometries within these bounds, a dict of parameter name -> (low, high)
+    inclusive, e.g. {'r': (42, 48.6)} for all radii or {'h1': (40, 40)}, needs the grid descriptor of the library
+    :return: candidates, best first, and their geometries
+    """
     start = time.time()
-
-    lib_files = os.listdir(lib_dir)
+    library = library_helper.open_library(lib_dir)
 
     # extract the keypoints from sstar
-    sstar_keyPoints = []
-    for starcnt, value in enumerate(sstar):  # extract the defined points of sstar
-        if value is not None:
-            sstar_keyPoints.append((starcnt, value))
-
-    spec_cnt = 0
-    batch_cnt = 0
-    for file in lib_files:
-        with open(os.path.join(lib_dir, file), 'rb') as lib:
-            spectra_batch = np.load(lib)
-            batch_cnt += 1
-            if batch_cnt > 5 and batch_cnt % 100 == 0:
-                print('analyzing batch {}, best MSE is {}, time taken is {}'.format(batch_cnt,
-                                                                                   np.round(candidates[0][1], 4),
-                                                                                   time.time()-start))
-            # consider each spectrum in the batch one at a time
-            for spectrum in spectra_batch:
-                spec_cnt += 1
-                # convert back to floats on [0, 1]
-                # calculate mse with desired spectrum
-                errors = []
-                for index, value in sstar_keyPoints:
-                    errors.append((spectrum[index]-value)**2)
-                mse = np.mean(errors)
-
-                if len(candidates) == 0:  # then we need more candidates, so append
-                    candidates.append([spectrum, mse, spec_cnt])
-                else:  # see if this spectrum is better than any of the current candidates
-                    for cand_cnt, candidate in enumerate(candidates):
-                        dist = np.linalg.norm(np.array(spectrum) - np.array(candidate[0]))
-                        if candidate[1] > mse:
-                            if dist < min_dist:
-                                candidates[cand_cnt] = [spectrum, mse, spec_cnt]
-                            else:
-                                candidates.append([spectrum, mse, spec_cnt])
-                            candidates.sort(key=lambda x: x[1])
-                            candidates = candidates[:candidate_num]  # take only the candidates with the lowest error
-                            break
-            if candidates[0][1] < threshold:
-                print('threshold {} reached, ending search.'.format(threshold))
-                break
-            elif spec_cnt > 212089987:  # 212089987 for 26% of total
-                print('got through ~26% of dataset, ending search.')
-                break
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    sstar_keyPoints = list(zip(key_idx, key_val))
+
+    # a query cache answers repeated queries without scanning, the row budget and the use of the zone map are part of
+    # the key since they change the result
+    cached = None
+    if cache is not None:
+        cache_key = cache.key(lib_dir, key_idx, key_val, candidate_num, min_dist=min_dist, threshold=threshold,
+                              max_rows=max_rows, use_zone_map=use_zone_map, constraints=constraints)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print('answered from the query cache')
+
+    if cached is not None:
+        mses, indices = cached
+    else:
+        progress = None
+        for progress in lookup_helper.iter_search(lib_dir, key_idx, key_val, candidate_num, n_workers=n_workers,
+                                                  use_zone_map=use_zone_map, threshold=threshold, min_dist=min_dist,
+                                                  max_rows=max_rows, max_seconds=max_seconds, interval=10,
+                                                  constraints=constraints):
+            if not progress.done:
+                print('analyzed batch {} of {}, best MSE is {}, time taken is {}'.format(
+                    progress.shards_done, progress.n_shards, np.round(progress.mses[0], 4), progress.elapsed))
+        if progress.stopped == 'threshold':
+            print('threshold {} reached, ending search.'.format(threshold))
+        elif progress.stopped == 'max_rows':
+            print('got through {} spectra, ending search.'.format(progress.n_scanned))
+        elif progress.stopped == 'max_seconds':
+            print('ran out of the {}s budget, ending search.'.format(max_seconds))
+        print('scanned {} spectra in {} of {} shards'.format(progress.n_scanned, progress.shards_done,
+                                                               progress.n_shards))
+        mses, indices = progress.mses, progress.indices
+        # a result cut short by the clock depends on the machine, it is not cached
+        if cache is not None and progress.stopped != 'max_seconds':
+            cache.put(cache_key, mses, indices)
     print('total search time taken is {}'.format(np.round(time.time() - start, 4)))
     #convert to arrays so we can slice
     sstar_keyPoints = np.array(sstar_keyPoints)
-    candidates = np.array(candidates)
+    # only now read the spectra of the final candidates back from the library
+    spectra = library.take(indices)
+    candidates = lookup_helper.candidate_array(spectra, mses, indices + 1)
 
-    # get the geometric values from the file of features
+    # get the geometric values of the candidates, spec_indices are 1-based grid rows
     spec_indices = candidates[:, 2]
     print('spec_indices are {}'.format(spec_indices))
-    geom_strings = []
-    geom_cnt = 0
-    with open(geometries_path, 'r') as geom_file:
-        for line in geom_file:
-            geom_cnt += 1
-            if geom_cnt in spec_indices:
-                geom_strings.append(line)
-                if len(geom_strings) == len(candidates):
-                    break
-    geom_strings_split = [geometries.split(',') for geometries in geom_strings]
-    geoms = []
-    for geom_set in geom_strings_split:
-        geoms.append([float(string) for string in geom_set])
-
-    # rearrange geom elements so that they match the order of candidates (sorted by MSE)
-    indices = sorted(range(len(candidates)), key=lambda k: candidates[k, 2])
-    geoms = [geoms[i] for i in indices]
-    print('geom_cnt is {}'.format(geom_cnt))
+    geoms = candidate_geometries(spec_indices, geometries_path, lib_dir)
     print('geometries are \n {}'.format(np.array(geoms)))
 
     # plot the defined sstar points along with the candidate
@@ -337,12 +639,149 @@ def lookupBin2(sstar, lib_dir, geometries_path, candidate_num, threshold, min_di
         plt.plot(candidate)
     return candidates, geoms
 
+
+# banded query answered from the sorted index of the library (see index_helper.build_sorted_index())
+def lookupBands(targets, lib_dir, geometries_path, candidate_num, n_intersect=2):
+    """
+    :param targets: dict of wavelength index -> (transmission, tolerance), e.g. {65: (0.56, 0.02), 82: (0.2, 0.02)}
+    :param lib_dir: library directory with a sorted index covering at least one of the wavelengths
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param candidate_num: number of candidates to return
+    :param n_intersect: number of indexed bands whose id sets are intersected
+    :return: candidates within every band, closest to the band centres first, and their geometries
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    bands = index_helper.transmission_bands(targets, scale=getattr(library, 'scale', 255))
+    mses, indices, n_survivors = index_helper.band_search(lib_dir, bands, candidate_num, n_intersect=n_intersect)
+    print('{} candidates out of {} survivors, search time taken is {}'.format(len(indices), n_survivors,
+                                                                              np.round(time.time() - start, 4)))
+    candidates = lookup_helper.candidate_array(library.take(indices), mses, indices + 1)
+    geoms = candidate_geometries(candidates[:, 2], geometries_path, lib_dir)
+    print('geometries are \n {}'.format(np.array(geoms)))
+    return candidates, geoms
+
+
+# approximate search, only the cells of the ann index closest to sstar are read (see ann_helper.build_ann_index())
+def lookupANN(sstar, lib_dir, geometries_path, candidate_num, n_probe=8):
+    """
+    :param sstar: target spectrum, a list with None at every undefined wavelength
+    :param lib_dir: library directory with an ann index
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param candidate_num: number of candidates to return
+    :param n_probe: number of cells read, see ann_helper.recall_report() for the recall it gives
+    :return: candidates, best first, and their geometries
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    mses, indices, n_scored = ann_helper.AnnIndex(lib_dir).search(key_idx, key_val, candidate_num, n_probe=n_probe)
+    print('scored {} of {} spectra, search time taken is {}'.format(n_scored, library.n_rows,
+                                                                    np.round(time.time() - start, 4)))
+    candidates = lookup_helper.candidate_array(library.take(indices), mses, indices + 1)
+    geoms = candidate_geometries(candidates[:, 2], geometries_path, lib_dir)
+    print('geometries are \n {}'.format(np.array(geoms)))
+    return candidates, geoms
+
+
+# coarse-to-fine search over the pyramid levels of the library (see lookup_helper.pyramid_search())
+def lookupPyramid(sstar, lib_dir, geometries_path, candidate_num, refine=(100, 10), n_workers=1):
+    """
+    :param sstar: target spectrum, a list with None at every undefined wavelength
+    :param lib_dir: library directory with pyramid levels
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param candidate_num: number of candidates to return
+    :param refine: number of rows kept at each pyramid level, coarsest first, as a multiple of candidate_num
+    :param n_workers: number of worker processes scanning the coarsest level
+    :return: candidates, best first, and their geometries
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    mses, indices = lookup_helper.pyramid_search(lib_dir, key_idx, key_val, candidate_num, refine=refine,
+                                                 n_workers=n_workers)
+    print('search time taken is {}'.format(np.round(time.time() - start, 4)))
+    candidates = lookup_helper.candidate_array(library.take(indices), mses, indices + 1)
+    geoms = candidate_geometries(candidates[:, 2], geometries_path, lib_dir)
+    print('geometries are \n {}'.format(np.array(geoms)))
+    return candidates, geoms
+
+
+# many targets answered in a single pass over the library (see lookup_helper.batch_search())
+def lookupBatch(sstars, lib_dir, geometries_path, candidate_num, n_workers=1, model_name=None, rerank_num=2000):
+    """
+    :param sstars: target spectra, lists with None at every undefined wavelength, the keypoints may differ
+    :param lib_dir: library directory
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param candidate_num: number of candidates to return per target
+    :param n_workers: number of worker processes
+    :param model_name: model the library was built with, if given the best rerank_num rows of each target are
+    predicted again in float32 and ranked on those spectra (see lookup_helper.rerank())
+    :param rerank_num: number of rows kept by the quantised scan for the float re-rank
+    :return: list with the candidates, best first, and their geometries for each target
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    first_num = max(candidate_num, rerank_num) if model_name is not None else candidate_num
+    results = lookup_helper.batch_search(lib_dir, sstars, first_num, n_workers=n_workers)
+    print('searched {} targets, time taken is {}'.format(len(sstars), np.round(time.time() - start, 4)))
+    if model_name is not None:
+        network = load_numpy_network(model_name)
+        grid = grid_helper.find_grid(lib_dir, geometries_path)
+        assert grid is not None, "the float re-rank needs a grid descriptor to find the candidate geometries"
+    answers = []
+    for sstar, (mses, indices) in zip(sstars, results):
+        if model_name is not None:
+            key_idx, key_val = lookup_helper.get_keypoints(sstar, dtype=np.float64)
+            mses, indices, spectra = lookup_helper.rerank(network, grid, key_idx, key_val, indices, candidate_num,
+                                                          scale=getattr(library, 'scale', 255))
+        else:
+            spectra = library.take(indices)
+        candidates = lookup_helper.candidate_array(spectra, mses, indices + 1)
+        answers.append((candidates, candidate_geometries(candidates[:, 2], geometries_path, lib_dir)))
+    print('total search time taken is {}'.format(np.round(time.time() - start, 4)))
+    return answers
+
+
+# two-stage search: the quantised library gives the best rerank_num rows, which are then ranked on float32 spectra
+# predicted again by the model, so near ties are not decided by the rounding of the library
+def lookupTwoStage(sstar, lib_dir, geometries_path, candidate_num, model_name, rerank_num=2000, n_workers=1):
+    """
+    :param sstar: target spectrum, a list with None at every undefined wavelength
+    :param lib_dir: library directory with a grid descriptor
+    :param geometries_path: path to grid.csv, searched for a grid descriptor next to it
+    :param candidate_num: number of candidates to return
+    :param model_name: model the library was built with
+    :param rerank_num: number of rows kept by the quantised scan
+    :param n_workers: number of worker processes of the quantised scan
+    :return: candidates, best first, with their float spectra (in library units) and their geometries
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    grid = grid_helper.find_grid(lib_dir, geometries_path)
+    assert grid is not None, "the float re-rank needs a grid descriptor to find the candidate geometries"
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    _, indices = lookup_helper.search(lib_dir, key_idx, key_val, max(candidate_num, rerank_num),
+                                      n_workers=n_workers)
+    print('quantised scan time taken is {}'.format(np.round(time.time() - start, 4)))
+    key_idx, key_val = lookup_helper.get_keypoints(sstar, dtype=np.float64)
+    mses, indices, spectra = lookup_helper.rerank(load_numpy_network(model_name), grid, key_idx, key_val, indices,
+                                                  candidate_num, scale=getattr(library, 'scale', 255))
+    print('total search time taken is {}'.format(np.round(time.time() - start, 4)))
+    candidates = lookup_helper.candidate_array(spectra, mses, indices + 1)
+    geoms = candidate_geometries(candidates[:, 2], geometries_path, lib_dir)
+    print('geometries are \n {}'.format(np.array(geoms)))
+    return candidates, geoms
+
+
 if __name__=="__main__":
+    # the interactive backend is only forced when lookup.py is run as a script, importing it stays headless
+    matplotlib.use('TkAgg')
     # gen_data(
     #     os.path.join('.', 'dataGrid', 'gridFiles'), param_bounds=np.array([
     #                                                          [30, 55],  [30, 55],  [30, 55],  [30, 55],
     #                                                          [42, 52.2], [42, 52.2], [42, 52.2], [42, 52.2]]),
-    #     spacings=[2,2,2,2, .8, .8, .8, .8])
+    #     spacings=[2,2,2,2, .8, .8, .8, .8], n_workers=os.cpu_count())
     modelNum = '20190508_155720'
     # import_data(os.path.join('.', 'dataIn', 'eval'), os.path.join('.', 'dataGrid'), batch_size=100, shuffle_size=100)
 
@@ -354,10 +793,16 @@ if __name__=="__main__":
     #      batch_size=1000)
     # print('main test time is {}'.format(time.time()-main_start))
 
+    ## pick batch size, thread counts and prefetch depth for this machine, main() then uses them by default
+    # tune_inference(data_dir=os.path.join('.', 'dataGrid', 'gridFiles'), model_name=modelNum)
+
     ## for main library computation
     # main(data_dir=os.path.join('.', 'dataGrid', 'gridFiles'),
     #      lib_dir=os.path.join('D:/dlmData/library20190506_174752'),
-    #      model_name=modelNum, batch_size=20000)
+    #      model_name=modelNum, batch_size=20000, resume=True)
+    # build_library(data_dir=os.path.join('.', 'dataGrid', 'gridFiles'),
+    #               lib_dir=os.path.join('D:/dlmData/library20190506_174752'),
+    #               model_name=modelNum, n_workers=8, batch_size=20000, resume=True)
 
     #define test sstar, see ML\lookupTest\findTestSpectra.nb
     spec = [None for i in range(300)]
@@ -378,7 +823,8 @@ if __name__=="__main__":
                       geometries_path=os.path.join('.', 'dataGrid', 'gridFiles', 'grid.csv'),
                       candidate_num=2,
                       threshold=50,
-                      min_dist=0)
+                      min_dist=0,
+                      n_workers=os.cpu_count())
 
     save_dir = os.path.join('.', 'dataGrid', 'candSave')
     with open(os.path.join(save_dir, 'lookup_' + time.strftime('%Y%m%d_%H%M%S', time.gmtime())+'.pkl'), 'wb') as f:
@@ -0,0 +1,694 @@
+import os
+import time
+import collections
+import multiprocessing
+import numpy as np
+
+import library_helper
+import grid_helper
+
+# Helper functions for searching the spectrum library built by lookup.main(). Kept free of tensorflow and
+# matplotlib so that they can be imported cheaply (e.g. by worker processes).
+
+
+# extract the defined points of sstar as a pair of arrays
+def get_keypoints(sstar, dtype=np.int32):
+    """
+    Extract the keypoints (defined, i.e. not None, values) of a target spectrum
+    :param sstar: target spectrum, a list with None at every undefined wavelength
+    :param dtype: dtype of the returned values, int32 for the uint8 library (values on [0, 255]) or a float type
+    :return: key_idx, the wavelength indices of the keypoints, and key_val, their values
+    """
+    key_idx = [cnt for cnt, value in enumerate(sstar) if value is not None]
+    key_val = [sstar[cnt] for cnt in key_idx]
+    assert len(key_idx) > 0, "sstar does not define any keypoints"
+    if np.issubdtype(dtype, np.integer):
+        key_val = np.rint(key_val)
+    return np.array(key_idx, dtype=np.intp), np.array(key_val, dtype=dtype)
+
+
+# score every spectrum of a library shard against the keypoints at once
+def score_batch(spectra_batch, key_idx, key_val):
+    """
+    Compute the sum of squared errors between each spectrum of a batch and the keypoints. With int32 keypoints
+    this works on the uint8 library values directly, accumulating in int32 (at most 300 * 255**2, so it cannot
+    overflow); with float keypoints the spectra are compared as floats
+    :param spectra_batch: array of spectra, shape (n, 300)
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints, as returned by get_keypoints()
+    :return: array of shape (n,) with the squared error of each spectrum, same dtype as key_val
+    """
+    diff = spectra_batch[:, key_idx].astype(key_val.dtype)
+    diff -= key_val
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+# same as score_batch() but normalised by the number of keypoints, i.e. the mse used throughout lookup.py
+def mse_batch(spectra_batch, key_idx, key_val):
+    return score_batch(spectra_batch, key_idx, key_val) / len(key_idx)
+
+
+class TopK(object):
+    """
+    Keeps the k best (lowest) scores seen so far together with the global library index of each spectrum.
+    Spectra themselves are not stored, they are fetched for the final k only once the search is done.
+    Ties are broken by the lower index, so the result does not depend on the order the batches are pushed in.
+    """
+    def __init__(self, k):
+        """
+        Initialize an empty selector
+        :param k: number of candidates to keep
+        """
+        assert k > 0, "k must be positive, got {}".format(k)
+        self.k = k
+        self.scores = np.empty(0, dtype=np.float64)
+        self.indices = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.scores)
+
+    @property
+    def best(self):
+        """
+        :return: the best score kept so far, inf if nothing has been pushed yet
+        """
+        return self.scores[0] if len(self.scores) else np.inf
+
+    @property
+    def worst(self):
+        """
+        :return: the score a spectrum has to beat (or tie) to enter the selection, inf until k are kept
+        """
+        return self.scores[-1] if len(self.scores) == self.k else np.inf
+
+    def push(self, scores, offset=0, indices=None):
+        """
+        Offer a batch of scores to the selector
+        :param scores: scores of the batch
+        :param offset: global index of the first element of the batch, used when indices is None
+        :param indices: global index of every element of the batch, defaults to offset + arange(len(scores))
+        :return:
+        """
+        scores = np.asarray(scores)
+        # only the elements that can still make it into the top k are worth looking at
+        keep = np.flatnonzero(scores <= self.worst)
+        if len(keep) > self.k:
+            # partial selection: everything strictly below the kth score, then the lowest-index ties
+            kth = np.partition(scores[keep], self.k - 1)[self.k - 1]
+            below = keep[scores[keep] < kth]
+            ties = keep[scores[keep] == kth][:self.k - len(below)]
+            keep = np.concatenate([below, ties])
+        if len(keep) == 0:
+            return
+        if indices is None:
+            new_indices = keep.astype(np.int64) + offset
+        else:
+            new_indices = np.asarray(indices, dtype=np.int64)[keep]
+        self._merge(scores[keep], new_indices)
+
+    def merge(self, other):
+        """
+        Merge the selection of another TopK (e.g. one computed on a different part of the library) into this one
+        :param other: TopK instance
+        :return:
+        """
+        self._merge(other.scores, other.indices)
+
+    def _merge(self, scores, indices):
+        scores = np.concatenate([self.scores, scores])
+        indices = np.concatenate([self.indices, indices])
+        order = np.lexsort((indices, scores))[:self.k]
+        self.scores = scores[order].astype(np.float64)
+        self.indices = indices[order]
+
+    def results(self):
+        """
+        :return: scores and global indices of the kept candidates, sorted from best to worst
+        """
+        return self.scores.copy(), self.indices.copy()
+
+
+# greedy non-maximum suppression: walk the spectra from the best score down, keeping each one that is at least
+# min_dist away from every spectrum kept before it
+def greedy_diverse(spectra, scores, indices, k, min_dist):
+    """
+    :param spectra: float32 spectra, shape (n, spec_len)
+    :param scores: score of each spectrum
+    :param indices: global index of each spectrum, breaks ties between equal scores
+    :param k: maximum number of spectra to keep
+    :param min_dist: minimum euclidean distance between two kept spectra
+    :return: positions of the kept spectra, best first
+    """
+    order = np.lexsort((indices, scores))
+    spectra = spectra[order]
+    suppressed = np.zeros(len(order), dtype=bool)
+    kept = []
+    for pos in range(len(order)):
+        if suppressed[pos]:
+            continue
+        kept.append(order[pos])
+        if len(kept) == k:
+            break
+        # one vectorized distance from the new pick to every spectrum after it
+        diff = spectra[pos + 1:] - spectra[pos]
+        suppressed[pos + 1:] |= np.einsum('ij,ij->i', diff, diff) < min_dist**2
+    return np.array(kept, dtype=np.int64)
+
+
+class DiverseTopK(object):
+    """
+    Keeps up to k low scores whose spectra are pairwise at least min_dist apart (euclidean distance in library
+    units), the same candidates as greedy_diverse() over the whole library. A spectrum can only be suppressed by a
+    better one that is kept itself, so the selection runs in rounds:
+    - a round keeps a pool of the pool_size best spectra (ties broken by the lower index) after the previous rounds,
+      leaving out those within min_dist of a candidate picked before, which cannot be picked any more
+    - at the end of the round, greedy_diverse() over the pool gives the next candidates. They are final, since every
+      better spectrum was in this pool or an earlier one
+    - if fewer than k candidates are picked so far and the pool was full, there may be more spectra to pick from
+      beyond the pool, and another round is needed (see next_round())
+    Every round picks at least one candidate, and on a grid library, where neighbouring geometries give nearly the
+    same spectrum, one round rarely does: the whole pool can lie within min_dist of the best spectrum
+    """
+    def __init__(self, k, min_dist, pool_size=None):
+        """
+        Initialize an empty selector
+        :param k: number of candidates to keep
+        :param min_dist: minimum euclidean distance between two candidates
+        :param pool_size: number of spectra kept per round, defaults to 64 * k
+        """
+        assert k > 0, "k must be positive, got {}".format(k)
+        self.k = k
+        self.min_dist = min_dist
+        self.pool_size = max(pool_size if pool_size is not None else 64 * k, k)
+        # candidates picked by the previous rounds
+        self.picks = (np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64), None)
+        # (score, index) of the last spectrum of the previous round, every spectrum up to it has been considered
+        self.floor = None
+        self.scores = np.empty(0, dtype=np.float64)
+        self.indices = np.empty(0, dtype=np.int64)
+        self.spectra = None
+
+    def __len__(self):
+        return len(self.picks[0]) + len(self.scores)
+
+    @property
+    def best(self):
+        """
+        :return: the best score kept so far, inf if nothing has been pushed yet
+        """
+        if len(self.picks[0]):
+            return self.picks[0][0]
+        return self.scores[0] if len(self.scores) else np.inf
+
+    @property
+    def worst(self):
+        """
+        :return: the score a spectrum has to beat (or tie) to enter the pool of this round, inf until it is full
+        """
+        return self.scores[-1] if len(self.scores) == self.pool_size else np.inf
+
+    def admit(self, scores, indices):
+        """
+        :param scores: scores of a batch
+        :param indices: global index of every element of the batch
+        :return: positions of the elements of the batch that can enter the pool of this round, best first. The
+        distance to the candidates picked before is only checked by push(), so all of them may be needed
+        """
+        scores = np.asarray(scores)
+        indices = np.asarray(indices)
+        keep = (scores <= self.worst) & np.isfinite(scores)
+        if self.floor is not None:
+            keep &= (scores > self.floor[0]) | ((scores == self.floor[0]) & (indices > self.floor[1]))
+        keep = np.flatnonzero(keep)
+        return keep[np.lexsort((indices[keep], scores[keep]))]
+
+    def push(self, spectra_batch, scores, offset=0, indices=None):
+        """
+        Offer a batch of spectra to the selector
+        :param spectra_batch: spectra of the batch, shape (n, spec_len), or a function returning the spectra of the
+        given positions of the batch, so that only the ones that can enter the pool are read
+        :param scores: scores of the batch
+        :param offset: global index of the first element of the batch, used when indices is None
+        :param indices: global index of every element of the batch, defaults to offset + arange(len(scores))
+        :return: number of spectra read
+        """
+        scores = np.asarray(scores)
+        if indices is None:
+            indices = np.arange(len(scores), dtype=np.int64) + offset
+        indices = np.asarray(indices, dtype=np.int64)
+        fetch = spectra_batch if callable(spectra_batch) else lambda pos: np.asarray(spectra_batch)[pos]
+        admitted = self.admit(scores, indices)
+        n_read = 0
+        # the admitted spectra are read best first, a pool at a time, until the rest cannot enter the pool
+        for first in range(0, len(admitted), self.pool_size):
+            pos = admitted[first:first + self.pool_size]
+            pos = pos[scores[pos] <= self.worst]
+            if len(pos) == 0:
+                break
+            spectra = fetch(pos)
+            n_read += len(pos)
+            # the spectra within min_dist of a final candidate can never be picked
+            survivors = np.ones(len(pos), dtype=bool)
+            for pick in self.picks[2] if self.picks[2] is not None else []:
+                diff = spectra.astype(np.float32) - pick.astype(np.float32)
+                survivors &= np.einsum('ij,ij->i', diff, diff) >= self.min_dist**2
+            pos, spectra = pos[survivors], spectra[survivors]
+            if self.spectra is None:
+                self.spectra = spectra[:0]
+            pool_scores = np.concatenate([self.scores, scores[pos]])
+            pool_indices = np.concatenate([self.indices, indices[pos]])
+            pool_spectra = np.concatenate([self.spectra, spectra])
+            order = np.lexsort((pool_indices, pool_scores))[:self.pool_size]
+            self.scores = pool_scores[order].astype(np.float64)
+            self.indices = pool_indices[order]
+            self.spectra = pool_spectra[order]
+        return n_read
+
+    def _select(self):
+        # greedy_diverse() over the candidates picked so far, which come first and are pairwise far enough apart,
+        # and the pool
+        scores = np.concatenate([self.picks[0], self.scores])
+        indices = np.concatenate([self.picks[1], self.indices])
+        parts = [part for part in (self.picks[2], self.spectra) if part is not None]
+        if not parts:
+            return scores, indices, np.empty((0, 0), dtype=np.uint8)
+        spectra = np.concatenate(parts)
+        chosen = greedy_diverse(spectra.astype(np.float32), scores, indices, self.k, self.min_dist)
+        return scores[chosen], indices[chosen], spectra[chosen]
+
+    def next_round(self):
+        """
+        End the current round, to be called once every spectrum has been offered
+        :return: True if the spectra have to be offered again for another round, False once the selection is final
+        """
+        if len(self.scores) < self.pool_size:
+            return False
+        picks = self._select()
+        if len(picks[0]) >= self.k:
+            return False
+        self.picks = picks
+        self.floor = (self.scores[-1], self.indices[-1])
+        self.scores = np.empty(0, dtype=np.float64)
+        self.indices = np.empty(0, dtype=np.int64)
+        self.spectra = None
+        return True
+
+    def results(self):
+        """
+        :return: scores, global indices and spectra (as pushed) of the kept candidates, sorted from best to worst
+        """
+        return self._select()
+
+
+# lower bound on the mse any spectrum of a shard can reach, from the zone map of the library
+def shard_bounds(mins, maxs, key_idx, key_val):
+    """
+    At each keypoint the spectra of a shard lie within [min, max] of that shard, so their error there is at least
+    the distance from the keypoint value to that interval
+    :param mins: per-wavelength minimum of each shard, shape (n_shards, spec_len)
+    :param maxs: per-wavelength maximum of each shard, shape (n_shards, spec_len)
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints, as returned by get_keypoints()
+    :return: array of shape (n_shards,), no spectrum of a shard has a lower mse_batch() than its bound
+    """
+    below = mins[:, key_idx].astype(key_val.dtype) - key_val
+    above = key_val - maxs[:, key_idx].astype(key_val.dtype)
+    gap = np.maximum(np.maximum(below, above), 0)
+    return np.einsum('ij,ij->i', gap, gap) / len(key_idx)
+
+
+# pack candidates into the [spectrum, mse, spectrum number] object array returned by the lookup functions
+def candidate_array(spectra, mses, spec_nums=None):
+    """
+    :param spectra: spectrum of each candidate
+    :param mses: mse of each candidate
+    :param spec_nums: 1-based library position of each candidate (the grid line it came from), omitted if None
+    :return: object array with one row per candidate
+    """
+    n_col = 2 if spec_nums is None else 3
+    candidates = np.empty((len(mses), n_col), dtype=object)
+    for cnt in range(len(mses)):
+        candidates[cnt, 0] = spectra[cnt]
+        candidates[cnt, 1] = mses[cnt]
+        if spec_nums is not None:
+            candidates[cnt, 2] = int(spec_nums[cnt])
+    return candidates
+
+
+# score a range of library rows, run inside the worker processes of scan_shards()
+def scan_shard(task):
+    """
+    :param task: tuple of (library directory, (start, stop) rows of the shard, key_idx, key_val, k, keep_mses,
+    select), select is None or (grid, lo, hi) to only score the rows within digit bounds (see
+    grid_helper.GridDescriptor.digit_bounds())
+    :return: the local TopK of the shard, the number of spectra scored and, if keep_mses, the mse of every spectrum
+    of the shard (inf for the rows outside select)
+    """
+    lib_dir, (start, stop), key_idx, key_val, k, keep_mses, select = task
+    library = library_helper.open_library(lib_dir)
+    top = TopK(k)
+    if select is None:
+        mses = mse_batch(library.rows(start, stop), key_idx, key_val)
+        top.push(mses, offset=start)
+        return top, stop - start, mses if keep_mses else None
+    # only the runs of rows within the bounds are read from the shard
+    grid, lo, hi = select
+    rows = np.concatenate([np.arange(run_start, run_stop) for run_start, run_stop in
+                           grid.row_ranges(lo, hi, start, stop)] + [np.empty(0, dtype=np.int64)])
+    if getattr(library, 'layout', 'row') == 'column':
+        # column layout: read the keypoint columns of the shard first, then pick the rows
+        selected = mse_batch(library.rows(start, stop)[:, key_idx][rows - start], np.arange(len(key_idx)), key_val)
+    else:
+        # take() indexes the memory-mapped files, so a whole .npy shard is not loaded for a few of its rows
+        selected = mse_batch(library.take(rows), key_idx, key_val)
+    top.push(selected, indices=rows)
+    if not keep_mses:
+        return top, len(rows), None
+    mses = np.full(stop - start, np.inf)
+    mses[rows - start] = selected
+    return top, len(rows), mses
+
+
+def scan_shards(lib_dir, shards, key_idx, key_val, k, n_workers=1, keep_mses=False, bounds=None, worst=None,
+                select=None):
+    """
+    Score every shard of the library, optionally spreading the shards over a pool of worker processes.
+    Results are always yielded in shard order, so merging them gives the same result as a serial scan, and the
+    caller can stop early at the same shard. Closing the generator terminates the pool.
+    With bounds, a shard is skipped without being read if its bound exceeds worst() when its turn comes; worst()
+    is typically the TopK.worst of the caller's selection, which improves as the yielded results are merged
+    :param lib_dir: library directory, in any format library_helper.open_library() can read
+    :param shards: (start, stop) library rows of each shard, in library order
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints
+    :param k: number of candidates each shard returns
+    :param n_workers: number of worker processes, scan in this process if 1
+    :param keep_mses: if True, also return the mse of every spectrum of the shard
+    :param bounds: lower bound on the mse of each shard, see shard_bounds()
+    :param worst: function returning the mse a shard has to be able to reach to be scanned, needed with bounds
+    :param select: (grid, lo, hi) to only score the rows within digit bounds of the grid, see scan_shard()
+    :return: generator of (position of the shard in shards, *scan_shard() result)
+    """
+    tasks = ((shard_id, (lib_dir, shard, key_idx, key_val, k, keep_mses, select))
+             for shard_id, shard in enumerate(shards))
+    if bounds is not None:
+        tasks = ((shard_id, task) for shard_id, task in tasks if bounds[shard_id] <= worst())
+    if n_workers <= 1:
+        for shard_id, task in tasks:
+            yield (shard_id,) + scan_shard(task)
+    elif bounds is not None:
+        # submit only a few shards per worker ahead of the results, so that the pruning test sees a recent worst()
+        pool = multiprocessing.Pool(n_workers)
+        pending = collections.deque()
+        try:
+            for shard_id, task in tasks:
+                pending.append((shard_id, pool.apply_async(scan_shard, (task,))))
+                if len(pending) >= 2 * n_workers:
+                    shard_id, result = pending.popleft()
+                    yield (shard_id,) + result.get()
+            while pending:
+                shard_id, result = pending.popleft()
+                yield (shard_id,) + result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            # small chunks keep the workers busy while still letting the caller stop early
+            results = pool.imap(scan_shard, (task for _, task in tasks), chunksize=4)
+            for shard_id, result in enumerate(results):
+                yield (shard_id,) + result
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+# snapshot of a running search, see iter_search()
+SearchProgress = collections.namedtuple('SearchProgress', ['mses', 'indices', 'n_scanned', 'bytes_read',
+                                                           'shards_done', 'n_shards', 'elapsed', 'done', 'stopped'])
+
+
+def iter_search(lib_dir, key_idx, key_val, k, n_workers=1, use_zone_map=True, threshold=0, min_dist=0,
+                zone_map=None, max_rows=None, max_seconds=None, interval=0, constraints=None, grid=None):
+    """
+    Top k of the library for one target as a generator of the evolving result, so the caller can show progress and
+    stop whenever the candidates are good enough (closing the generator stops the scan and its workers). Shards are
+    visited with the lowest zone map bound first when the library has a zone map, and skipped once they cannot
+    hold a candidate
+    :param lib_dir: library directory
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints, as returned by get_keypoints()
+    :param k: number of candidates
+    :param n_workers: number of worker processes
+    :param use_zone_map: order and skip the shards with the zone map, see shard_bounds()
+    :param threshold: stop as soon as the best mse is below threshold
+    :param min_dist: minimum euclidean distance between two candidates, see DiverseTopK, the library may be scanned
+    more than once (in rounds) to find them
+    :param zone_map: shards, mins and maxs as returned by library_helper.read_zone_map(), read from lib_dir if None
+    :param max_rows: stop once this many spectra have been scored, no limit if None
+    :param max_seconds: stop once the search has run this long, no limit if None
+    :param interval: yield after every shard if 0, at most once per interval seconds otherwise, only the final
+    result if None
+    :param constraints: only search the geometries within these bounds, a dict of parameter name -> (low, high)
+    inclusive, see grid_helper.GridDescriptor.digit_bounds(). Shards without such a geometry are not read and only
+    the matching runs of rows are read from the others
+    :param grid: GridDescriptor of the library, found in lib_dir if None, only needed with constraints
+    :return: generator of SearchProgress: the mses and library rows of the current candidates (best first), the
+    number of spectra scored, an estimate of the bytes read for them, the number of shards visited (scanned or
+    skipped) out of n_shards, the elapsed seconds, whether the search is over and why it stopped early ('threshold',
+    'max_rows' or 'max_seconds', None if it went through the library)
+    """
+    start = time.time()
+    library = library_helper.open_library(lib_dir)
+    shards = library.shards
+    bounds = None
+    if use_zone_map and zone_map is None:
+        zone_map = library_helper.read_zone_map(lib_dir)
+    if use_zone_map and zone_map is not None and [tuple(shard) for shard in zone_map[0].tolist()] == list(shards):
+        bounds = shard_bounds(zone_map[1], zone_map[2], key_idx, key_val)
+        order = np.argsort(bounds, kind='stable')
+        shards = [shards[shard_id] for shard_id in order]
+        bounds = bounds[order]
+    select = None
+    if constraints is not None:
+        grid = grid if grid is not None else grid_helper.find_grid(lib_dir)
+        assert grid is not None, "constrained searches need the grid descriptor of the library"
+        assert library.n_rows <= grid.n_rows, "the library has more rows than its grid"
+        lo, hi = grid.digit_bounds(constraints)
+        select = (grid, lo, hi)
+        # drop the shards that hold no geometry within the constraints
+        starts, stops = np.array(shards, dtype=np.int64).reshape(-1, 2).T
+        inside = grid.count_below(stops, lo, hi) > grid.count_below(starts, lo, hi)
+        shards = [shard for shard, keep in zip(shards, inside) if keep]
+        bounds = bounds[inside] if bounds is not None else None
+    # the column layout only reads the keypoint columns of a shard, the other formats read whole rows
+    row_bytes = len(key_idx) if getattr(library, 'layout', 'row') == 'column' else library.spec_len
+    top = DiverseTopK(k, min_dist) if min_dist > 0 else TopK(k)
+    n_scanned = 0
+    bytes_read = 0
+    last_yield = start
+    stopped = None
+
+    def progress(shards_done, done):
+        mses, indices = top.results()[:2]
+        return SearchProgress(mses, indices, n_scanned, bytes_read, shards_done, len(shards), time.time() - start,
+                              done, stopped)
+
+    # a diverse selection may need more than one pass over the library, see DiverseTopK
+    shards_done = 0
+    next_round = True
+    while next_round and stopped is None:
+        shard_results = scan_shards(lib_dir, shards, key_idx, key_val, k, n_workers=n_workers,
+                                    keep_mses=min_dist > 0, bounds=bounds, worst=lambda: top.worst, select=select)
+        try:
+            for shard_id, shard_top, shard_size, mses in shard_results:
+                if min_dist > 0:
+                    # only the rows that can enter the pool are read again, for their spectra
+                    rows = np.arange(len(mses)) + shards[shard_id][0]
+                    bytes_read += top.push(lambda pos: library.take(rows[pos]), mses, indices=rows) * library.spec_len
+                else:
+                    top.merge(shard_top)
+                n_scanned += shard_size
+                bytes_read += shard_size * row_bytes
+                shards_done = shard_id + 1
+                if top.best < threshold:
+                    stopped = 'threshold'
+                elif max_rows is not None and n_scanned >= max_rows:
+                    stopped = 'max_rows'
+                elif max_seconds is not None and time.time() - start >= max_seconds:
+                    stopped = 'max_seconds'
+                if stopped is not None:
+                    break
+                if interval is not None and time.time() - last_yield >= interval:
+                    yield progress(shards_done, False)
+                    last_yield = time.time()
+        finally:
+            shard_results.close()
+        next_round = min_dist > 0 and stopped is None and top.next_round()
+    if stopped is None:
+        shards_done = len(shards)
+        n_found = len(top.results()[0])
+        if min_dist > 0 and n_found < k:
+            print('warning: only {} spectra of the search are at least {} apart, fewer than the {} candidates asked '
+                  'for'.format(n_found, min_dist, k))
+    yield progress(shards_done, True)
+
+
+# top k of the whole library for one target, without plotting or printing (see iter_search())
+def search(lib_dir, key_idx, key_val, k, n_workers=1, use_zone_map=True, threshold=0, min_dist=0, zone_map=None,
+           cache=None, constraints=None, grid=None):
+    """
+    :param lib_dir: library directory
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints, as returned by get_keypoints()
+    :param k: number of candidates
+    :param n_workers: number of worker processes
+    :param use_zone_map: skip the shards that cannot hold a candidate, see shard_bounds()
+    :param threshold: stop as soon as the best mse is below threshold, 0 scans the whole library
+    :param min_dist: minimum euclidean distance between two candidates, see DiverseTopK
+    :param zone_map: shards, mins and maxs as returned by library_helper.read_zone_map(), read from lib_dir if None
+    :param cache: query_cache.QueryCache, repeated queries are answered from it without scanning
+    :param constraints: only search the geometries within these bounds, see iter_search()
+    :param grid: GridDescriptor of the library, found in lib_dir if None, only needed with constraints
+    :return: mses and library rows of the candidates, sorted from best to worst
+    """
+    if cache is not None:
+        cache_key = cache.key(lib_dir, key_idx, key_val, k, min_dist=min_dist, threshold=threshold,
+                              use_zone_map=use_zone_map, constraints=constraints)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+    for result in iter_search(lib_dir, key_idx, key_val, k, n_workers=n_workers, use_zone_map=use_zone_map,
+                              threshold=threshold, min_dist=min_dist, zone_map=zone_map, interval=None,
+                              constraints=constraints, grid=grid):
+        pass
+    if cache is not None:
+        cache.put(cache_key, result.mses, result.indices)
+    return result.mses, result.indices
+
+
+# keypoints of a batch of targets, gathered from one set of columns
+def batch_keypoints(sstars, dtype=np.int32):
+    """
+    :param sstars: target spectra, lists with None at every undefined wavelength, the keypoints may differ
+    :param dtype: dtype of the keypoint values, see get_keypoints()
+    :return: the union of the wavelength indices of all the targets and, for each target, the positions of its
+    keypoints within the union and their values
+    """
+    keypoints = [get_keypoints(sstar, dtype=dtype) for sstar in sstars]
+    union_idx = np.unique(np.concatenate([key_idx for key_idx, _ in keypoints]))
+    targets = [(np.searchsorted(union_idx, key_idx), key_val) for key_idx, key_val in keypoints]
+    return union_idx, targets
+
+
+# score a range of library rows against every target of a batch, run inside the worker processes of batch_search()
+def scan_shard_batch(task):
+    """
+    :param task: tuple of (library directory, (start, stop) rows of the shard, union_idx, targets, k), see
+    batch_keypoints()
+    :return: the local TopK of the shard for each target
+    """
+    lib_dir, (start, stop), union_idx, targets, k = task
+    # read the columns any target needs once, every target is then scored from memory
+    spectra_batch = library_helper.open_library(lib_dir).rows(start, stop)[:, union_idx]
+    tops = []
+    for key_pos, key_val in targets:
+        top = TopK(k)
+        top.push(mse_batch(spectra_batch, key_pos, key_val), offset=start)
+        tops.append(top)
+    return tops
+
+
+def batch_search(lib_dir, sstars, k, n_workers=1):
+    """
+    Exact top k of many targets in a single pass over the library, each shard is read once for the whole batch
+    :param lib_dir: library directory
+    :param sstars: target spectra, sparse or dense, the keypoints may differ from target to target
+    :param k: number of candidates per target
+    :param n_workers: number of worker processes
+    :return: list with the mses and library rows of the candidates of each target, sorted from best to worst
+    """
+    library = library_helper.open_library(lib_dir)
+    union_idx, targets = batch_keypoints(sstars)
+    tops = [TopK(k) for _ in targets]
+    tasks = ((lib_dir, shard, union_idx, targets, k) for shard in library.shards)
+    if n_workers <= 1:
+        results = map(scan_shard_batch, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap(scan_shard_batch, tasks, chunksize=4)
+    try:
+        for shard_tops in results:
+            for top, shard_top in zip(tops, shard_tops):
+                top.merge(shard_top)
+    finally:
+        if n_workers > 1:
+            pool.terminate()
+            pool.join()
+    return [top.results() for top in tops]
+
+
+# second stage of a two-stage search: predict the spectra of the first stage candidates again in float, from their
+# grid geometries, and rank them on those instead of on the quantised library values
+def rerank(network, grid, key_idx, key_val, indices, k, scale=255):
+    """
+    :param network: model with a predict(geometries) method, e.g. numpy_network.NumpyNetwork
+    :param grid: grid_helper.GridDescriptor of the library (library row i is grid row i)
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints in library units, unrounded (get_keypoints(sstar, dtype=np.float64))
+    :param indices: library rows of the first stage candidates
+    :param k: number of candidates to keep
+    :param scale: quantisation scale of the library, the float spectra are compared in the same units
+    :return: mses, library rows and float spectra (in library units) of the best k, sorted from best to worst
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    spectra = np.clip(network.predict(grid.geometry(indices).astype(np.float32)), 0, 1) * scale
+    top = TopK(k)
+    top.push(mse_batch(spectra, key_idx, key_val), indices=indices)
+    mses, rows = top.results()
+    sorter = np.argsort(indices)
+    return mses, rows, spectra[sorter[np.searchsorted(indices, rows, sorter=sorter)]]
+
+
+def pyramid_search(lib_dir, key_idx, key_val, k, refine=(100, 10), n_workers=1, chunk_size=2**16):
+    """
+    Coarse-to-fine search over the pyramid levels of a library (see library_helper.build_pyramid()). The coarsest
+    level is scanned in full, each keypoint being compared with the mean of its block, and only its best rows are
+    scored at the next finer level, down to the full resolution spectra. The coarse score is not a bound on the
+    full resolution mse, so refine trades speed for the chance of missing a candidate
+    :param lib_dir: library directory with pyramid levels
+    :param key_idx: wavelength indices of the keypoints
+    :param key_val: values of the keypoints, as returned by get_keypoints()
+    :param k: number of candidates
+    :param refine: number of rows kept at each level, coarsest first, as a multiple of k. Levels beyond the ones
+    the library has are ignored
+    :param n_workers: number of worker processes scanning the coarsest level
+    :param chunk_size: number of rows read at a time when refining
+    :return: mses and library rows of the candidates, sorted from best to worst
+    """
+    factors = library_helper.pyramid_levels(lib_dir)[::-1][:len(refine)]
+    assert len(factors) > 0, "{} has no pyramid levels, see library_helper.build_pyramid()".format(lib_dir)
+    level_dirs = [os.path.join(lib_dir, library_helper.pyramid_name(factor)) for factor in factors]
+
+    # scan the coarsest level
+    coarsest = library_helper.open_library(level_dirs[0])
+    top = TopK(k * refine[0])
+    for _, shard_top, _, _ in scan_shards(level_dirs[0], coarsest.shards, key_idx // factors[0], key_val,
+                                          top.k, n_workers=n_workers):
+        top.merge(shard_top)
+    _, rows = top.results()
+
+    # refine the survivors at the finer levels, then at full resolution
+    level_dirs = level_dirs[1:] + [lib_dir]
+    factors = factors[1:] + [1]
+    keep = [k * multiple for multiple in refine[1:len(factors)]] + [k]
+    for level_dir, factor, n_keep in zip(level_dirs, factors, keep):
+        library = library_helper.open_library(level_dir)
+        rows = np.sort(rows)
+        top = TopK(n_keep)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            top.push(mse_batch(library.take(chunk), key_idx // factor, key_val), indices=chunk)
+        mses, rows = top.results()
+    return mses, rows
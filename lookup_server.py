@@ -0,0 +1,350 @@
+import os
+import argparse
+import json
+import time
+import socket
+import asyncio
+
+import library_helper
+import lookup_helper
+import grid_helper
+import query_cache
+
+# Long-running lookup service. The library, its zone map and its grid descriptor are opened once when the server
+# starts, so a query only pays for the scan itself instead of the start up of lookup.py and a cold library. The
+# server speaks a minimal HTTP over TCP or over a Unix socket:
+#   POST /lookup with a JSON query, answered with one JSON line per candidate (best first) and a final summary line
+#   GET /status, answered with one JSON line describing the library and the queries served so far
+# A query holds the keypoints in library units (0-255), either as "sstar" (a list with null at every undefined
+# wavelength, as in lookupBin2()) or as "keypoints" ({wavelength index: value}), and optionally "k", "threshold",
+# "min_dist", "spectra" (include the spectrum of each candidate), "max_rows" and "max_seconds" (budgets of the
+# scan), "progress" (stream a progress line at most every that many seconds while scanning, see
+# lookup_helper.iter_search()) and "constraints" (only search the geometries within {parameter: [low, high]}).
+# Only numpy is needed, tensorflow is not imported.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BODY = 2**20
+
+
+class LookupService(object):
+    """
+    Holds a library warm and answers queries against it
+    """
+    def __init__(self, lib_dir, geometries_path=None, n_workers=1, use_zone_map=True, cache_dir=None):
+        """
+        Open the library once
+        :param lib_dir: library directory, in any format library_helper.open_library() can read
+        :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+        :param n_workers: number of worker processes per query
+        :param use_zone_map: skip the shards that cannot hold a candidate
+        :param cache_dir: directory of a query_cache.QueryCache answering repeated queries, no cache if None
+        """
+        self.lib_dir = lib_dir
+        self.geometries_path = geometries_path
+        self.n_workers = n_workers
+        self.library = library_helper.open_library(lib_dir)
+        self.zone_map = library_helper.read_zone_map(lib_dir) if use_zone_map else None
+        self.use_zone_map = use_zone_map
+        self.grid = grid_helper.find_grid(lib_dir, geometries_path)
+        self.cache = query_cache.QueryCache(cache_dir) if cache_dir is not None else None
+        self.n_queries = 0
+        self.started = time.time()
+
+    def keypoints(self, query):
+        """
+        :param query: decoded JSON query
+        :return: key_idx, key_val of the query, see lookup_helper.get_keypoints()
+        """
+        if 'sstar' in query:
+            sstar = query['sstar']
+        elif 'keypoints' in query:
+            sstar = [None] * self.library.spec_len
+            for wavelength, value in query['keypoints'].items():
+                sstar[int(wavelength)] = value
+        else:
+            raise ValueError('the query needs "sstar" or "keypoints"')
+        if len(sstar) != self.library.spec_len:
+            raise ValueError('sstar must have {} values, got {}'.format(self.library.spec_len, len(sstar)))
+        if all(value is None for value in sstar):
+            raise ValueError('the query does not define any keypoints')
+        return lookup_helper.get_keypoints(sstar)
+
+    def geometries(self, indices):
+        """
+        :param indices: library rows
+        :return: geometry of each row, None for every row if the grid is unknown
+        """
+        if self.grid is not None:
+            return self.grid.geometry(indices).tolist()
+        if self.geometries_path is not None:
+            return grid_helper.read_grid_rows(self.geometries_path, indices).tolist()
+        return [None] * len(indices)
+
+    def stream(self, query):
+        """
+        Check a query and return the generator answering it, the scan only starts when the generator is iterated
+        :param query: decoded JSON query, see the top of this module
+        :return: generator of JSON lines: progress lines if the query asks for them, one line per candidate (best
+        first) and a summary line
+        """
+        key_idx, key_val = self.keypoints(query)
+        k = int(query.get('k', 10))
+        if k <= 0:
+            raise ValueError('k must be positive, got {}'.format(k))
+        threshold = float(query.get('threshold', 0))
+        min_dist = float(query.get('min_dist', 0))
+        budget = {'max_rows': query.get('max_rows'), 'max_seconds': query.get('max_seconds')}
+        interval = query.get('progress')
+        constraints = query.get('constraints')
+        if constraints is not None:
+            if self.grid is None:
+                raise ValueError('constrained queries need the grid descriptor of the library')
+            constraints = {name: (float(low), float(high)) for name, (low, high) in constraints.items()}
+            # raises ValueError for unknown parameters
+            self.grid.digit_bounds(constraints)
+        return self._lines(query, key_idx, key_val, k, threshold, min_dist, budget, interval, constraints)
+
+    def _lines(self, query, key_idx, key_val, k, threshold, min_dist, budget, interval, constraints):
+        start = time.time()
+        summary = {'done': True}
+        if interval is None and budget['max_rows'] is None and budget['max_seconds'] is None:
+            mses, indices = lookup_helper.search(self.lib_dir, key_idx, key_val, k, n_workers=self.n_workers,
+                                                 use_zone_map=self.use_zone_map, threshold=threshold,
+                                                 min_dist=min_dist, zone_map=self.zone_map, cache=self.cache,
+                                                 constraints=constraints, grid=self.grid)
+        else:
+            # streamed or budgeted queries follow the scan as it goes and are not cached
+            for progress in lookup_helper.iter_search(self.lib_dir, key_idx, key_val, k, n_workers=self.n_workers,
+                                                      use_zone_map=self.use_zone_map, threshold=threshold,
+                                                      min_dist=min_dist, zone_map=self.zone_map,
+                                                      interval=None if interval is None else float(interval),
+                                                      constraints=constraints, grid=self.grid, **budget):
+                if not progress.done:
+                    yield {'progress': progress_dict(progress)}
+            mses, indices = progress.mses, progress.indices
+            summary.update(progress_dict(progress))
+        spectra = self.library.take(indices) if query.get('spectra', False) else None
+        for rank, (mse, index, geometry) in enumerate(zip(mses, indices, self.geometries(indices))):
+            candidate = {'rank': rank, 'mse': float(mse), 'row': int(index), 'geometry': geometry}
+            if spectra is not None:
+                candidate['spectrum'] = spectra[rank].tolist()
+            yield candidate
+        self.n_queries += 1
+        summary.update({'n_candidates': len(mses), 'time': time.time() - start})
+        yield summary
+
+    def answer(self, query):
+        """
+        Run a query, blocks until the scan is done
+        :param query: decoded JSON query, see the top of this module
+        :return: list of candidate dicts, best first, and the summary dict
+        """
+        lines = [line for line in self.stream(query) if 'progress' not in line]
+        return lines[:-1], lines[-1]
+
+    def status(self):
+        return {'lib_dir': self.lib_dir, 'n_rows': self.library.n_rows, 'n_shards': len(self.library.shards),
+                'zone_map': self.zone_map is not None, 'grid': self.grid is not None, 'n_queries': self.n_queries,
+                'uptime': time.time() - self.started, 'cache': self.cache.stats() if self.cache is not None else None}
+
+
+# counters of a lookup_helper.SearchProgress, without the candidates
+def progress_dict(progress):
+    return {'best_mse': float(progress.mses[0]) if len(progress.mses) else None, 'n_scanned': progress.n_scanned,
+            'bytes_read': progress.bytes_read, 'shards_done': progress.shards_done, 'n_shards': progress.n_shards,
+            'elapsed': progress.elapsed, 'stopped': progress.stopped}
+
+
+def json_line(obj):
+    return (json.dumps(obj) + '\n').encode('utf-8')
+
+
+# read one http request from the stream: method, path and body
+async def read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) < 2:
+        raise ValueError('malformed request line')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError('request body larger than {} bytes'.format(MAX_BODY))
+    body = await reader.readexactly(length) if length else b''
+    return request_line[0].upper(), request_line[1], body
+
+
+# step through a blocking generator in a thread, so the event loop keeps serving other connections meanwhile
+async def iter_in_executor(lines):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            line = await loop.run_in_executor(None, next, lines, None)
+            if line is None:
+                break
+            yield line
+    finally:
+        # stops the scan (and its worker processes) if the client went away
+        await loop.run_in_executor(None, lines.close)
+
+
+async def write_response(writer, status, lines):
+    """
+    :param writer: asyncio stream of the connection
+    :param status: http status line, e.g. '200 OK'
+    :param lines: list, or async generator, of the JSON lines of the answer
+    """
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n'.format(
+        status).encode('latin-1'))
+    if isinstance(lines, list):
+        for line in lines:
+            writer.write(json_line(line))
+        await writer.drain()
+        return
+    try:
+        async for line in lines:
+            writer.write(json_line(line))
+            # send every line as soon as it is ready, so clients see the progress of the scan
+            await writer.drain()
+    finally:
+        await lines.aclose()
+
+
+def make_handler(service):
+    """
+    :param service: LookupService answering the queries
+    :return: connection callback for asyncio.start_server() / asyncio.start_unix_server()
+    """
+    async def handle(reader, writer):
+        try:
+            try:
+                method, path, body = await read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                await write_response(writer, '400 Bad Request', [{'error': str(e)}])
+                return
+            if method == 'GET' and path == '/status':
+                await write_response(writer, '200 OK', [service.status()])
+            elif method == 'POST' and path == '/lookup':
+                try:
+                    lines = service.stream(json.loads(body.decode('utf-8')))
+                except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+                    await write_response(writer, '400 Bad Request', [{'error': str(e)}])
+                    return
+                except Exception as e:
+                    # answer anyway, the client would otherwise only see the connection close
+                    await write_response(writer, '500 Internal Server Error', [{'error': repr(e)}])
+                    return
+                await write_response(writer, '200 OK', iter_in_executor(lines))
+            else:
+                await write_response(writer, '404 Not Found', [{'error': 'unknown endpoint {} {}'.format(method,
+                                                                                                          path)}])
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def start_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+    """
+    :param service: LookupService answering the queries
+    :param host: address to listen on over TCP
+    :param port: port to listen on over TCP, 0 picks a free one
+    :param unix_path: listen on this Unix socket instead of TCP
+    :return: the asyncio server
+    """
+    if unix_path is not None:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        return await asyncio.start_unix_server(make_handler(service), path=unix_path)
+    return await asyncio.start_server(make_handler(service), host=host, port=port)
+
+
+def serve(lib_dir, geometries_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, n_workers=1,
+          use_zone_map=True, cache_dir=None):
+    """
+    Open the library and answer queries until interrupted
+    :param lib_dir: library directory
+    :param geometries_path: path to grid.csv, only read if the library has no grid descriptor
+    :param host: address to listen on over TCP
+    :param port: port to listen on over TCP
+    :param unix_path: listen on this Unix socket instead of TCP
+    :param n_workers: number of worker processes per query
+    :param use_zone_map: skip the shards that cannot hold a candidate
+    :param cache_dir: directory of the query cache, no cache if None
+    :return:
+    """
+    service = LookupService(lib_dir, geometries_path=geometries_path, n_workers=n_workers,
+                            use_zone_map=use_zone_map, cache_dir=cache_dir)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(start_server(service, host=host, port=port, unix_path=unix_path))
+    print('serving {} ({} spectra) on {}'.format(lib_dir, service.library.n_rows,
+                                                 unix_path or '{}:{}'.format(host, port)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+# blocking client, e.g. for scripts and notebooks
+def request(query=None, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, timeout=None):
+    """
+    :param query: JSON query (dict), posted to /lookup, None gets /status
+    :param host: server address over TCP
+    :param port: server port over TCP
+    :param unix_path: Unix socket of the server, used instead of TCP if given
+    :param timeout: socket timeout in seconds
+    :return: list of the decoded JSON lines of the answer
+    """
+    if unix_path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(unix_path)
+    else:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    with sock, sock.makefile('rb') as f:
+        if query is None:
+            sock.sendall(b'GET /status HTTP/1.1\r\nHost: lookup\r\n\r\n')
+        else:
+            body = json.dumps(query).encode('utf-8')
+            sock.sendall('POST /lookup HTTP/1.1\r\nHost: lookup\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(len(body)).encode('latin-1') + body)
+        status = f.readline().decode('latin-1').split(None, 2)
+        if len(status) < 2:
+            raise RuntimeError('lookup server closed the connection without answering')
+        while f.readline().strip():
+            pass
+        lines = [json.loads(line.decode('utf-8')) for line in f if line.strip()]
+    if status[1] != '200':
+        raise RuntimeError('lookup server answered {}: {}'.format(' '.join(status[1:]).strip(), lines))
+    return lines
+
+
+def read_flag():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lib_dir', type=str, help='library directory')
+    parser.add_argument('--geometries-path', default=os.path.join('.', 'dataGrid', 'gridFiles', 'grid.csv'),
+                        type=str, help='grid.csv, only read if the library has no grid descriptor')
+    parser.add_argument('--host', default=DEFAULT_HOST, type=str, help='address to listen on')
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int, help='port to listen on')
+    parser.add_argument('--unix-path', default=None, type=str, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--n-workers', default=1, type=int, help='number of worker processes per query')
+    parser.add_argument('--cache-dir', default=None, type=str, help='directory of the query cache, none if not given')
+    flags = parser.parse_args()
+    return flags
+
+
+if __name__ == "__main__":
+    flags = read_flag()
+    serve(flags.lib_dir, geometries_path=flags.geometries_path, host=flags.host, port=flags.port,
+          unix_path=flags.unix_path, n_workers=flags.n_workers, cache_dir=flags.cache_dir)
@@ -1,4 +1,5 @@
 import os
+import re
 import time
 import tfplot
 import numpy as np
@@ -6,6 +7,8 @@ import tensorflow as tf
 import matplotlib.pyplot as plt
 import matplotlib
 
+import numpy_network
+
 
 class Hook(object):
     """
@@ -242,4 +245,36 @@ def get_parameters(model_dir):
         elif line[:9] =='reg_scale':
             line = replace_str(line)
             reg_scale = float(line[11:])
-    return clip[0], fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch[0], reg_scale
\ No newline at end of file
+    return clip[0], fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch[0], reg_scale
+
+# export the weights of a trained my_model_fn_tens() checkpoint to a single .npz file, so that
+# numpy_network.NumpyNetwork can run the network without tensorflow
+def export_weights(model_dir, out_file=None):
+    """
+    :param model_dir: model directory, holding the checkpoint and model_meta.txt
+    :param out_file: output file, defaults to numpy_network.WEIGHTS_NAME inside model_dir
+    :return: path of the exported weights
+    """
+    clip, fc_filters, tconv_Fnums, tconv_dims, tconv_filters, n_filter, n_branch, \
+    reg_scale = get_parameters(model_dir)
+    if out_file is None:
+        out_file = os.path.join(model_dir, numpy_network.WEIGHTS_NAME)
+    reader = tf.train.NewCheckpointReader(tf.train.latest_checkpoint(model_dir))
+
+    weights = {'clip': clip, 'tconv_dims': np.array(tconv_dims), 'n_dense': len(fc_filters)}
+    for cnt in range(len(fc_filters)):
+        weights['dense_kernel_{}'.format(cnt)] = reader.get_tensor('fc{}/kernel'.format(cnt))
+        weights['dense_bias_{}'.format(cnt)] = reader.get_tensor('fc{}/bias'.format(cnt))
+    # the transposed convolution filters are unnamed tf.Variables, numbered in the order they were created
+    tconv_names = [name for name in reader.get_variable_to_shape_map() if re.match(r'^Variable(_\d+)?$', name)]
+    tconv_names.sort(key=lambda name: int(name.split('_')[1]) if '_' in name else 0)
+    assert len(tconv_names) == len(tconv_dims), \
+        "expected {} transposed convolution filters, found {}".format(len(tconv_dims), tconv_names)
+    for cnt, name in enumerate(tconv_names):
+        weights['tconv_filter_{}'.format(cnt)] = reader.get_tensor(name)
+    weights['final_kernel'] = reader.get_tensor('conv_final/kernel')
+    weights['final_bias'] = reader.get_tensor('conv_final/bias')
+
+    np.savez(out_file, **weights)
+    print('exported weights to {}'.format(out_file))
+    return out_file
@@ -4,6 +4,7 @@ import inspect
 import numpy as np
 import tensorflow as tf
 import struct
+import library_helper
 
 
 class CnnNetwork(object):
@@ -296,29 +297,75 @@ class CnnNetwork(object):
 
 # write it to a number of different files which are smaller, using np.save()
     def predictBin3(self, pred_init_op, ckpt_dir, save_file=os.path.join(os.path.dirname(__file__), 'dataGrid'),
-                model_name=''):
+                model_name='', resume=False, config=None):
         """
         Evaluate the model, and save predictions to binary save_file
         :param ckpt_dir directory
         :param save_file: full path to pred file
         :param model_name: name of the model
+        :param resume: continue an interrupted build, pred_init_op has to start at library_helper.resume_row()
+        :param config: tf.ConfigProto of the session, e.g. to pin the thread pools
         :return:
         """
-        with tf.Session() as sess:
+        # every shard is written atomically and recorded with its checksum in the build log of the library
+        if resume:
+            _, completed = library_helper.resume_build_log(save_file)
+        else:
+            library_helper.start_build_log(save_file, {'model_name': model_name, 'format': 'npy'})
+            completed = []
+        row_cnt = completed[-1]['stop'] if completed else 0
+        # files are written by a background thread, so the next batch is predicted while the last one is saved
+        with tf.Session(config=config) as sess, library_helper.BackgroundWriter() as writer:
             self.load(sess, ckpt_dir)
             sess.run(pred_init_op)
             pred_file = os.path.join(save_file)
             file_prefix = 'test_pred_{}_'.format(model_name)
             try:
-                file_cnt = 0
+                file_cnt = len(completed)
                 while True:
                     pred_batch = sess.run(self.logits)
                     # network occasionally predicts value slightly outside [0,1], so clip these out
                     # then map [0,1] --> [0,255], int
-                    preduint64 = np.array([np.round(x*255) for x in np.clip(pred_batch, a_min=0, a_max=1)]).astype('uint8')
-                    f = os.path.join(pred_file, file_prefix + str(file_cnt).zfill(5) + '.npy')
-                    np.save(f, preduint64, allow_pickle=False)
+                    preduint64 = library_helper.quantise(pred_batch)
+                    f = file_prefix + str(file_cnt).zfill(5) + '.npy'
+                    writer.submit(library_helper.save_shard, pred_file, f, row_cnt, preduint64)
+                    row_cnt += len(preduint64)
                     file_cnt+=1
             except tf.errors.OutOfRangeError:
-                return pred_file,
-                pass
\ No newline at end of file
+                pass
+        # all shards are on disk once the background writer has drained, save their envelopes as the zone map
+        library_helper.zone_map_from_build_log(pred_file)
+        return pred_file,
+
+# write it to one (or a few) large memory-mappable files plus a json manifest, see library_helper.LibraryWriter
+    def predictBin4(self, pred_init_op, ckpt_dir, save_file=os.path.join(os.path.dirname(__file__), 'dataGrid'),
+                model_name='', layout='row', resume=False, config=None, pyramid_factors=()):
+        """
+        Evaluate the model, and save predictions to a memory-mapped library
+        :param ckpt_dir directory
+        :param save_file: library directory
+        :param model_name: name of the model
+        :param layout: 'row' or 'column', see library_helper.LibraryWriter
+        :param resume: continue an interrupted build, pred_init_op has to start at library_helper.resume_row()
+        :param config: tf.ConfigProto of the session, e.g. to pin the thread pools
+        :param pyramid_factors: downsampling factors of the pyramid levels written with the library
+        :return:
+        """
+        # batches are appended by a background thread, so the next batch is predicted while the last one is saved.
+        # the library writer is closed (and its manifest written) only after the background writer has drained
+        with tf.Session(config=config) as sess, \
+                library_helper.LibraryWriter(save_file, model_name, spec_len=self.logits.shape[1].value,
+                                             layout=layout, resume=resume,
+                                             pyramid_factors=pyramid_factors) as lib_writer, \
+                library_helper.BackgroundWriter() as writer:
+            self.load(sess, ckpt_dir)
+            sess.run(pred_init_op)
+            try:
+                while True:
+                    pred_batch = sess.run(self.logits)
+                    # network occasionally predicts value slightly outside [0,1], so clip these out
+                    # then map [0,1] --> [0,255], int
+                    preduint64 = library_helper.quantise(pred_batch)
+                    writer.submit(lib_writer.append, preduint64)
+            except tf.errors.OutOfRangeError:
+                return save_file,
@@ -0,0 +1,186 @@
+import os
+import numpy as np
+
+import library_helper
+
+# Forward pass of utils.my_model_fn_tens() in pure numpy, so that spectra can be predicted without tensorflow (no
+# graph to build, no session to start). The weights are exported from a trained checkpoint with
+# network_helper.export_weights().
+
+WEIGHTS_NAME = 'weights_numpy.npz'
+# 'float32' runs the exported weights as they are, 'float16' rounds them to half precision and 'int8' quantises the
+# dense kernels (which hold nearly all the weights) to int8 with one scale per output unit. The reduced precisions
+# are simulated to measure the error they would add: the rounded kernels are widened back to the compute dtype once,
+# so the forward pass costs the same as in float32 (numpy has no fast float16 or int8 matmul)
+PRECISIONS = ('float32', 'float16', 'int8')
+CALIBRATION_PERCENTILES = (100, 99.999, 99.99, 99.9)
+
+
+# tf.nn.leaky_relu with its default alpha
+def leaky_relu(x, alpha=0.2):
+    return np.maximum(x, alpha * x)
+
+
+def conv1d_transpose(value, filter, out_width, stride):
+    """
+    Transposed 1d convolution with 'SAME' padding, as computed by tf.contrib.nn.conv1d_transpose
+    :param value: input of shape (batch, in_width, in_channels)
+    :param filter: filter of shape (filter_width, out_channels, in_channels)
+    :param out_width: width of the output
+    :param stride: stride
+    :return: output of shape (batch, out_width, out_channels)
+    """
+    batch, in_width, _ = value.shape
+    filter_width, out_channels, _ = filter.shape
+    pad_left = max((in_width - 1) * stride + filter_width - out_width, 0) // 2
+    out = np.zeros((batch, out_width, out_channels), dtype=value.dtype)
+    # input position i contributes to output position i*stride + k - pad_left through filter tap k
+    positions = np.arange(in_width) * stride - pad_left
+    for k in range(filter_width):
+        out_pos = positions + k
+        valid = (out_pos >= 0) & (out_pos < out_width)
+        out[:, out_pos[valid], :] += np.matmul(value[:, valid, :], filter[k].T)
+    return out
+
+
+def quantise_weights(kernel, percentile=100):
+    """
+    Symmetric int8 quantisation of a dense kernel, with one scale per output unit
+    :param kernel: kernel of shape (in_units, out_units)
+    :param percentile: percentile of |kernel| mapped to 127 in each column, larger weights are clipped
+    :return: int8 kernel and float32 scales of shape (out_units,), kernel ~ q * scale
+    """
+    bound = np.percentile(np.abs(kernel), percentile, axis=0)
+    scale = np.where(bound > 0, bound / 127, 1).astype(np.float32)
+    q = np.clip(np.rint(kernel / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+
+class NumpyNetwork(object):
+    """
+    Runs a trained my_model_fn_tens() network in numpy
+    """
+    def __init__(self, weights_path, dtype=np.float32, precision='float32'):
+        """
+        Load the exported weights
+        :param weights_path: file written by network_helper.export_weights(), or the model directory holding it
+        :param dtype: dtype the forward pass is computed in
+        :param precision: precision the weights are stored in, one of PRECISIONS
+        """
+        if os.path.isdir(weights_path):
+            weights_path = os.path.join(weights_path, WEIGHTS_NAME)
+        self.dtype = dtype
+        with np.load(weights_path) as weights:
+            self.clip = int(weights['clip'])
+            self.tconv_dims = [int(dim) for dim in weights['tconv_dims']]
+            n_dense = int(weights['n_dense'])
+            self.dense_kernels = [weights['dense_kernel_{}'.format(cnt)].astype(dtype) for cnt in range(n_dense)]
+            self.dense_biases = [weights['dense_bias_{}'.format(cnt)].astype(dtype) for cnt in range(n_dense)]
+            self.tconv_filters = [weights['tconv_filter_{}'.format(cnt)].astype(dtype)
+                                  for cnt in range(len(self.tconv_dims))]
+            self.final_kernel = weights['final_kernel'].astype(dtype)
+            self.final_bias = weights['final_bias'].astype(dtype)
+        self.set_precision(precision)
+
+    def set_precision(self, precision, percentiles=None):
+        """
+        Round the dense kernels used by the forward pass to the given precision
+        :param precision: one of PRECISIONS
+        :param percentiles: for 'int8', the clipping percentile of each dense layer (see quantise_weights()),
+        defaults to 100 (no clipping) or to the result of the last calibrate()
+        :return:
+        """
+        assert precision in PRECISIONS, "precision must be one of {}, got {}".format(PRECISIONS, precision)
+        self.precision = precision
+        if precision == 'int8':
+            if percentiles is None:
+                percentiles = getattr(self, 'percentiles', [100] * len(self.dense_kernels))
+            self.percentiles = list(percentiles)
+            self.kernels = []
+            for kernel, percentile in zip(self.dense_kernels, self.percentiles):
+                q, scale = quantise_weights(kernel, percentile)
+                self.kernels.append(q.astype(self.dtype) * scale.astype(self.dtype))
+        else:
+            self.kernels = [kernel.astype(precision).astype(self.dtype) for kernel in self.dense_kernels]
+
+    def calibrate(self, features, percentiles=CALIBRATION_PERCENTILES):
+        """
+        Pick the int8 clipping percentile of each dense layer that brings the output closest to the float32 output
+        on a set of calibration geometries, one layer at a time
+        :param features: calibration geometries of shape (n, 24), a few thousand rows of the grid or eval set
+        :param percentiles: candidate percentiles
+        :return: the chosen percentile of each dense layer
+        """
+        self.set_precision('float32')
+        reference = self.predict(features)
+        chosen = [100] * len(self.dense_kernels)
+        for cnt in range(len(self.dense_kernels)):
+            errors = []
+            for percentile in percentiles:
+                chosen[cnt] = percentile
+                self.set_precision('int8', chosen)
+                errors.append(np.mean(np.square(self.predict(features) - reference)))
+            chosen[cnt] = percentiles[int(np.argmin(errors))]
+        self.set_precision('int8', chosen)
+        print('calibrated int8 clipping percentiles: {}'.format(chosen))
+        return chosen
+
+    def forward(self, features):
+        """
+        :param features: geometries of shape (batch, 24)
+        :return: predicted spectra of shape (batch, tconv_dims[-1] - 2*clip)
+        """
+        fc = np.asarray(features, dtype=self.dtype)
+        # dense layers
+        for kernel, bias in zip(self.kernels, self.dense_biases):
+            fc = leaky_relu(np.matmul(fc, kernel) + bias)
+        up = fc[:, :, np.newaxis]
+        feature_dim = fc.shape[1]
+
+        # transposed convolutional layers
+        for f, up_size in zip(self.tconv_filters, self.tconv_dims):
+            up = conv1d_transpose(up, f, up_size, up_size // feature_dim)
+            feature_dim = up_size
+
+        # 1x1 convolutional layer
+        up = np.matmul(up, self.final_kernel[0]) + self.final_bias
+        return up[:, self.clip:up.shape[1] - self.clip, 0]
+
+    def predict(self, features, batch_size=4096):
+        """
+        :param features: geometries of shape (n, 24)
+        :param batch_size: number of geometries per forward pass, bounds the memory used
+        :return: predicted spectra of shape (n, tconv_dims[-1] - 2*clip)
+        """
+        features = np.asarray(features)
+        return np.concatenate([self.forward(features[start:start + batch_size])
+                               for start in range(0, max(len(features), 1), batch_size)])
+
+
+# error added by a reduced precision mode, relative to float32
+def precision_error(network, features, precision, calib_features=None, scale=255):
+    """
+    :param network: NumpyNetwork, left in the requested precision
+    :param features: geometries to compare on, e.g. the eval set
+    :param precision: one of PRECISIONS
+    :param calib_features: for 'int8', calibrate the clipping percentiles on these geometries first (not on features,
+    which would fit the clipping to the geometries the error is reported on), no calibration if None
+    :param scale: quantisation scale of the library, to report the error in library units
+    :return: dict with the max and mean absolute error of the spectra, the max error after quantisation to the
+    library's uint8 values and the fraction of those values that change
+    """
+    network.set_precision('float32')
+    reference = network.predict(features)
+    if precision == 'int8' and calib_features is not None:
+        network.calibrate(calib_features)
+    else:
+        network.set_precision(precision)
+    pred = network.predict(features)
+    error = np.abs(pred - reference)
+    quantised_error = np.abs(library_helper.quantise(pred, scale).astype(np.int16) -
+                             library_helper.quantise(reference, scale).astype(np.int16))
+    return {'precision': precision,
+            'max_error': float(np.max(error)),
+            'mean_error': float(np.mean(error)),
+            'max_uint8_error': int(np.max(quantised_error)),
+            'uint8_changed': float(np.mean(quantised_error > 0))}
@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+import library_helper
+
+# On-disk cache of lookup results. An entry holds the mses and library rows of the candidates of one query, stored
+# as a small json file named after the hash of the query: the identity of the library (library_helper.library_id(),
+# so rebuilding or resuming the library or its zone map invalidates its entries), the keypoints as the integer
+# library values the search scores with, k, min_dist, threshold and the options of the search. The cache is bounded
+# in bytes and evicts the least recently used entries first, the modification time of an entry being refreshed on
+# every hit.
+
+ENTRY_SUFFIX = '.json'
+
+
+class QueryCache(object):
+    """
+    Size-bounded LRU cache of lookup results in a directory, shared by every process that opens the same directory
+    """
+    def __init__(self, cache_dir, max_bytes=64 * 2**20):
+        """
+        :param cache_dir: directory of the entries, created if needed
+        :param max_bytes: total size of the entries above which the least recently used ones are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, lib_dir, key_idx, key_val, k, min_dist=0, threshold=0, **options):
+        """
+        :param lib_dir: library directory
+        :param key_idx: wavelength indices of the keypoints
+        :param key_val: values of the keypoints, as returned by lookup_helper.get_keypoints()
+        :param k: number of candidates
+        :param min_dist: minimum distance between two candidates
+        :param threshold: mse at which the search stops early
+        :param options: any other json serialisable setting that changes the result of the search
+        :return: hex key of the query
+        """
+        # keypoints sorted by wavelength, get_keypoints() already rounds the values to the integers of the library,
+        # so targets that only differ below the quantisation step share their entry
+        order = np.argsort(key_idx, kind='stable')
+        query = {'library': library_helper.library_id(lib_dir),
+                 'key_idx': np.asarray(key_idx)[order].tolist(),
+                 'key_val': np.asarray(key_val)[order].tolist(),
+                 'k': int(k), 'min_dist': float(min_dist), 'threshold': float(threshold), 'options': options}
+        return hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        :param key: key of the query, see key()
+        :return: mses and library rows of the cached candidates, None on a miss
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            # mark the entry as recently used
+            os.utime(path, None)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return np.array(entry['mses'], dtype=np.float64), np.array(entry['indices'], dtype=np.int64)
+
+    def put(self, key, mses, indices):
+        """
+        Store the result of a query, then evict the least recently used entries if the cache is over max_bytes
+        :param key: key of the query, see key()
+        :param mses: mses of the candidates
+        :param indices: library rows of the candidates
+        :return:
+        """
+        entry = {'mses': np.asarray(mses, dtype=np.float64).tolist(),
+                 'indices': np.asarray(indices, dtype=np.int64).tolist()}
+        tmp_path = self.path(key) + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (modification time, size, path) of the entries, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # evicted by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            with self.lock:
+                self.evictions += 1
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+
+    def stats(self):
+        """
+        :return: dict with the hits, misses and evictions counted by this instance, its hit rate, and the number and
+        total size of the entries on disk
+        """
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'n_entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import library_helper
+import lookup_helper
+import grid_helper
+
+# Tests of the diverse search on a library shaped like a real one: the spectra are a smooth function of the
+# geometries of a lattice, so neighbouring rows give nearly the same spectrum and the best rows cluster together.
+
+
+@pytest.fixture(scope='module')
+def lattice_library(tmp_path_factory):
+    lib_dir = str(tmp_path_factory.mktemp('lattice'))
+    grid = grid_helper.GridDescriptor([[30, 40]] * 4 + [[42, 46]] * 4, [2] * 4 + [1] * 4)
+    params = grid.params(np.arange(grid.n_rows))
+    params = (params - params.mean(axis=0)) / params.std(axis=0)
+    features = params @ np.random.default_rng(0).normal(size=(8, 3))
+    wavelengths = np.linspace(0, 1, 300)
+    data = np.clip(128 + 60 * np.sin(3 * wavelengths + 0.05 * features[:, :1]) +
+                   3 * features[:, 1:2] * wavelengths + 2 * features[:, 2:3], 0, 255).astype(np.uint8)
+    with library_helper.LibraryWriter(lib_dir, 'test', rows_per_file=2**14) as writer:
+        for start in range(0, grid.n_rows, 5000):
+            writer.append(data[start:start + 5000])
+    return lib_dir, data
+
+
+@pytest.mark.parametrize('min_dist', [10, 30, 60])
+@pytest.mark.parametrize('use_zone_map', [True, False])
+def test_diverse_search_matches_global_greedy(lattice_library, min_dist, use_zone_map):
+    lib_dir, data = lattice_library
+    sstar = [None] * data.shape[1]
+    for wavelength in np.random.default_rng(1).choice(data.shape[1], 12, replace=False):
+        sstar[wavelength] = int(data[12345, wavelength])
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    mses = lookup_helper.mse_batch(data, key_idx, key_val)
+    order = np.lexsort((np.arange(len(data)), mses))
+    expected = order[lookup_helper.greedy_diverse(data[order].astype(np.float32), mses[order], order, 5, min_dist)]
+    _, indices = lookup_helper.search(lib_dir, key_idx, key_val, 5, min_dist=min_dist, use_zone_map=use_zone_map)
+    assert len(indices) == 5
+    assert indices.tolist() == expected.tolist()
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import numpy as np
+import pytest
+
+import library_helper
+import lookup_helper
+import grid_helper
+import lookup_server
+
+# End to end tests of the lookup server: a small library is written with LibraryWriter, served on a free TCP port
+# from a background event loop, and the answers of lookup_server.request() are checked against a brute force scan.
+
+
+@pytest.fixture(scope='module')
+def library(tmp_path_factory):
+    lib_dir = str(tmp_path_factory.mktemp('library'))
+    grid = grid_helper.GridDescriptor([[30, 40]] * 4 + [[42, 46]] * 4, [2] * 4 + [1] * 4)
+    rng = np.random.default_rng(5)
+    basis = np.cumsum(rng.normal(size=(8, 300)), axis=1)
+    data = np.clip(128 + rng.normal(size=(grid.n_rows, 8)) @ basis * 2, 0, 255).astype(np.uint8)
+    with library_helper.LibraryWriter(lib_dir, 'test', rows_per_file=4096) as writer:
+        for start in range(0, grid.n_rows, 5000):
+            writer.append(data[start:start + 5000])
+    grid.save(lib_dir)
+    return lib_dir, grid, data
+
+
+@pytest.fixture(scope='module')
+def port(library):
+    service = lookup_server.LookupService(library[0])
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(lookup_server.start_server(service, port=0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[1]
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+def target(data, row, n_keypoints=12, seed=0):
+    sstar = [None] * data.shape[1]
+    for wavelength in np.random.default_rng(seed).choice(data.shape[1], n_keypoints, replace=False):
+        sstar[wavelength] = int(data[row, wavelength])
+    return sstar
+
+
+def brute_force(data, sstar, k, rows=None):
+    key_idx, key_val = lookup_helper.get_keypoints(sstar)
+    rows = np.arange(len(data)) if rows is None else rows
+    top = lookup_helper.TopK(k)
+    top.push(lookup_helper.mse_batch(data[rows], key_idx, key_val), indices=rows)
+    return top.results()
+
+
+def test_lookup_matches_brute_force(library, port):
+    lib_dir, grid, data = library
+    sstar = target(data, 777)
+    lines = lookup_server.request({'sstar': sstar, 'k': 5, 'spectra': True}, port=port)
+    candidates, summary = lines[:-1], lines[-1]
+    mses, rows = brute_force(data, sstar, 5)
+    assert [candidate['row'] for candidate in candidates] == rows.tolist()
+    assert np.allclose([candidate['mse'] for candidate in candidates], mses)
+    assert summary['n_candidates'] == 5
+    for candidate in candidates:
+        assert candidate['spectrum'] == data[candidate['row']].tolist()
+        assert np.allclose(candidate['geometry'], grid.geometry([candidate['row']])[0])
+
+
+def test_keypoints_and_streaming(library, port):
+    lib_dir, grid, data = library
+    sstar = target(data, 4321, seed=1)
+    keypoints = {str(wavelength): value for wavelength, value in enumerate(sstar) if value is not None}
+    lines = lookup_server.request({'keypoints': keypoints, 'k': 3, 'progress': 0}, port=port)
+    assert any('progress' in line for line in lines)
+    candidates = [line for line in lines if 'row' in line]
+    assert [candidate['row'] for candidate in candidates] == brute_force(data, sstar, 3)[1].tolist()
+
+
+def test_constrained_lookup(library, port):
+    lib_dir, grid, data = library
+    sstar = target(data, 1234, seed=2)
+    constraints = {'r': [42, 43], 'h1': [32, 36]}
+    lines = lookup_server.request({'sstar': sstar, 'k': 5, 'constraints': constraints}, port=port)
+    lo, hi = grid.digit_bounds(constraints)
+    digits = grid.digits(np.arange(grid.n_rows))
+    inside = np.flatnonzero(np.all((digits >= lo) & (digits < hi), axis=1))
+    assert [line['row'] for line in lines[:-1]] == brute_force(data, sstar, 5, rows=inside)[1].tolist()
+
+
+@pytest.mark.parametrize('query, message', [
+    ({'sstar': [None] * 300}, 'keypoints'),
+    ({'sstar': [100] * 300, 'constraints': {'x1': [0, 1]}}, 'unknown parameter'),
+    ({'k': 5}, 'sstar'),
+])
+def test_bad_queries_are_answered(port, query, message):
+    with pytest.raises(RuntimeError, match='400') as error:
+        lookup_server.request(query, port=port)
+    assert message in str(error.value)
+
+
+def test_status(library, port):
+    status = lookup_server.request(port=port)[0]
+    assert status['n_rows'] == len(library[2]) and status['grid']
@@ -15,13 +15,16 @@ def repeat_2d(input_, axis, batch_size, repeat_num):
         orig_shape = input_.get_shape().as_list()
         input_ = tf.tile(input_, (1, repeat_num, 1))
         orig_shape.insert(axis, repeat_num)
-        # orig_shape[orig_shape.index(None)] = batch_size
+        # the batch dimension may only be known at runtime, let reshape infer it
+        orig_shape = [-1 if dim is None else dim for dim in orig_shape]
         return tf.reshape(input_, shape=orig_shape)
 
 
 def tensor_layer(input_, out_dim, batch_size, layer_id):
     # D is considered column vector here, not the row vector as in the paper
     in_dim = input_.get_shape().as_list()[1]
+    # broadcast to the runtime batch size, batch_size is only kept for compatibility
+    batch_size = tf.shape(input_)[0]
     var_w = tf.get_variable(name='w_k_{}'.format(layer_id), shape=[out_dim, in_dim, in_dim],
                             initializer=tf.keras.initializers.glorot_normal())
     var_w = tf.broadcast_to(var_w, [batch_size, out_dim, in_dim, in_dim])
@@ -69,9 +72,10 @@ def conv1d_transpose_wrap(value,
 
     dyn_input_shape = tf.shape(value)
     batch_size = dyn_input_shape[0]
-    output_shape = tf.stack([batch_size, output_shape[1], output_shape[2]])
+    out_width, out_channels = output_shape[1], output_shape[2]
+    output_shape = tf.stack([batch_size, out_width, out_channels])
 
-    return tf.contrib.nn.conv1d_transpose(
+    up = tf.contrib.nn.conv1d_transpose(
         value,
         filter,
         output_shape,
@@ -80,6 +84,9 @@ def conv1d_transpose_wrap(value,
         data_format=data_format,
         name=name
     )
+    # keep the static width and channels, only the batch dimension is dynamic
+    up.set_shape([None, out_width, out_channels])
+    return up
 
 
 def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=False):
@@ -177,6 +184,7 @@ def my_model_fn_tens(features, batch_size, clip,
     """
     My customized model function
     :param features: input features
+    :param batch_size: training batch size, the graph itself accepts batches of any size
     :param output_size: dimension of output data
     :return:
     """
@@ -203,7 +211,7 @@ def my_model_fn_tens(features, batch_size, clip,
         stride = up_size // feature_dim
         feature_dim = up_size
         f = tf.Variable(tf.random_normal([up_fNum, up_filter, last_filter]))
-        up = conv1d_transpose_wrap(up, f, [batch_size, up_size, up_filter], stride, name='up{}'.format(cnt))
+        up = conv1d_transpose_wrap(up, f, [None, up_size, up_filter], stride, name='up{}'.format(cnt))
         last_filter = up_filter
 
     # convolutional layer